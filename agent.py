@@ -1,14 +1,20 @@
+import asyncio
+import functools
 import os
 import json
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
 import time
 import traceback
+import httpx
 from typing import Optional
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain.tools import BaseTool, Tool
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.memory import ConversationBufferMemory, ChatMessageHistory
@@ -16,110 +22,273 @@ from cbeta_tool import CBETASearcher
 from cbeta_retrieval import CBETARetriever
 from user_context import get_user_context, get_recent_messages_for_context
 
-# 配置日志
+# 詳細日誌與代理追蹤開關：生產環境默認關閉，避免每輪LLM呼叫都
+# 同步序列化工具調用軌跡到磁盤與stdout
+LC_VERBOSE = os.getenv("LC_VERBOSE") == "1"
+
+# 配置日志：實際的磁盤/stdout寫入經 QueueListener 在後台線程執行，
+# 請求路徑上的 handler 只做無鎖入隊
+_log_queue = queue.SimpleQueue()
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_file_handler = logging.FileHandler("agent.log")
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(_log_formatter)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _file_handler, _stream_handler, respect_handler_level=True
+)
+_log_listener.start()
+
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("agent.log"),
-        logging.StreamHandler(sys.stdout)
-    ]
+    level=logging.INFO if LC_VERBOSE else logging.WARNING,
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
 logger = logging.getLogger("agent")
 
-# 載入 CBETA 工具
-cbeta_searcher = CBETASearcher()
+# 啟用全局 LLM 回應快取：重複的確定性 prompt（快速回覆、新聞摘要等）
+# 直接命中本地快取，省去整趟 OpenAI 往返與 token 費用。
+# 多 worker 部署時設置 REDIS_URL 以共享快取。
+try:
+    from langchain_core.globals import set_llm_cache
+
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        import redis
+        from langchain_community.cache import RedisCache
+        set_llm_cache(RedisCache(redis.Redis.from_url(redis_url)))
+        logger.info("已啟用 Redis LLM 快取")
+    else:
+        from langchain_community.cache import SQLiteCache
+        set_llm_cache(SQLiteCache(database_path=".bodhi_llm_cache.db"))
+        logger.info("已啟用 SQLite LLM 快取")
+except Exception as e:
+    logger.warning(f"無法啟用 LLM 快取: {e}")
+
+# 語義快取：語義相近的查詢（如「什麼是唯識」vs「唯識是什麼」）直接命中舊答案，
+# 同時省去向量檢索與 LLM 呼叫。需要 REDIS_URL 與 redisvl，缺少時自動停用。
+_semantic_cache = None
+try:
+    if os.getenv("REDIS_URL"):
+        from redisvl.extensions.llmcache import SemanticCache
+        _semantic_cache = SemanticCache(
+            name="bodhi_sem_cache",
+            redis_url=os.getenv("REDIS_URL"),
+            distance_threshold=0.2,
+        )
+        logger.info("已啟用語義快取")
+except Exception as e:
+    logger.warning(f"無法啟用語義快取: {e}")
+
+def check_semantic_cache(prompt: str) -> Optional[str]:
+    """查詢語義快取，未啟用或未命中時返回 None。"""
+    if _semantic_cache is None:
+        return None
+    try:
+        hit = _semantic_cache.check(prompt=prompt)
+        if hit:
+            return hit[0]["response"]
+    except Exception as e:
+        logger.warning(f"語義快取查詢失敗: {e}")
+    return None
+
+def store_semantic_cache(prompt: str, response: str) -> None:
+    """將問答寫入語義快取，未啟用時為 no-op。"""
+    if _semantic_cache is None:
+        return
+    try:
+        _semantic_cache.store(prompt=prompt, response=response)
+    except Exception as e:
+        logger.warning(f"語義快取寫入失敗: {e}")
+
+# CBETA 工具單例：加載語料與嵌入索引的成本高（數百MB、數秒起），
+# 整個進程只建一次，所有用戶代理共享；以鎖保護首次延遲初始化
+_cbeta_searcher = None
+_cbeta_retriever = None
+_cbeta_lock = threading.Lock()
+
+def _get_cbeta_searcher() -> CBETASearcher:
+    global _cbeta_searcher
+    if _cbeta_searcher is None:
+        with _cbeta_lock:
+            if _cbeta_searcher is None:
+                _cbeta_searcher = CBETASearcher()
+    return _cbeta_searcher
+
+def _get_cbeta_retriever() -> CBETARetriever:
+    global _cbeta_retriever
+    if _cbeta_retriever is None:
+        with _cbeta_lock:
+            if _cbeta_retriever is None:
+                _cbeta_retriever = CBETARetriever()
+    return _cbeta_retriever
 
 # 用户聊天历史
 user_memories = {}
 
+# 傳給 LLM 的聊天歷史滑動窗口大小（10 條 = 5 輪對話）
+MAX_CHAT_HISTORY_MESSAGES = 10
+
+# 模型分流：高流量的快速回覆/新聞/禪修指令走便宜快速的模型，
+# 只有自由問答的法義分支保留 gpt-4-turbo
+DEEP_MODEL = "gpt-4-turbo"
+FAST_MODEL = "gpt-4o-mini"
+
+# 共享的 LLM 客戶端：所有模型實例復用同一個 httpx 連接池，
+# 免去每個新用戶首次呼叫時的 TCP/TLS 握手
+_http_client = None
+_llm_instances = {}
+_llm_lock = threading.Lock()
+
+def _get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_keepalive_connections=100,
+                max_connections=200
+            ),
+            timeout=30
+        )
+    return _http_client
+
+def _get_llm(openai_api_key: str, model: str = DEEP_MODEL,
+             temperature: float = 0.7, streaming: bool = True) -> ChatOpenAI:
+    """延遲初始化並返回按 (model, temperature) 共享的 ChatOpenAI 實例。"""
+    key = (model, temperature)
+    if key not in _llm_instances:
+        with _llm_lock:
+            if key not in _llm_instances:
+                _llm_instances[key] = ChatOpenAI(
+                    model=model,
+                    temperature=temperature,
+                    streaming=streaming,
+                    openai_api_key=openai_api_key,
+                    http_client=_get_http_client()
+                )
+    return _llm_instances[key]
+
+@functools.lru_cache(maxsize=4096)
+def _format_cbeta_reference_cached(doc_id: str, title: str) -> str:
+    """按 (doc_id, title) 快取引用格式化結果。
+
+    同一部經的段落在代理推理循環中反覆出現，缺標題時的原始文檔
+    線性掃描只需做一次。
+    """
+    return _get_cbeta_searcher().format_cbeta_reference({'doc_id': doc_id, 'title': title})
+
 def cbeta_tool_func(query: str) -> str:
     try:
         logger.info(f"CBETA搜索: {query}")
-        results = cbeta_searcher.search(query, return_full_paragraph=True)
+
+        # 語義快取命中時直接返回，跳過嵌入與向量檢索
+        cached = check_semantic_cache(f"cbeta:{query}")
+        if cached is not None:
+            logger.info("CBETA搜索: 語義快取命中")
+            return cached
+
+        results = _get_cbeta_searcher().search(query, return_full_paragraph=True)
         if not results:
             logger.info("CBETA搜索: 未找到相關經文")
             return "未找到相關經文。"
         
-        formatted_results = []
-        for doc in results:
-            # 原文完整段落
-            full_paragraph = doc['content']
-            # 引用信息
-            reference = cbeta_searcher.format_cbeta_reference(doc)
-            formatted_results.append(f"【原文】\n{full_paragraph}\n\n【來源】\n{reference}")
-        
         logger.info(f"CBETA搜索: 找到 {len(results)} 條結果")
-        return "\n\n---\n\n".join(formatted_results)
+        formatted = "\n\n---\n\n".join(
+            f"【原文】\n{doc['content']}\n\n【來源】\n"
+            f"{_format_cbeta_reference_cached(doc.get('doc_id', doc.get('id', '')), doc.get('title', ''))}"
+            for doc in results
+        )
+        store_semantic_cache(f"cbeta:{query}", formatted)
+        return formatted
     except Exception as e:
         logger.error(f"CBETA搜索錯誤: {str(e)}", exc_info=True)
         return f"檢索經文時發生錯誤: {str(e)}"
 
+async def acbeta_tool_func(query: str) -> str:
+    """cbeta_tool_func 的異步版本。
+
+    檢索是 CPU 密集的本地向量運算，放到線程池執行，讓工具呼叫
+    與 LLM 請求共享事件循環而不佔住 executor 槽位。
+    """
+    return await asyncio.to_thread(cbeta_tool_func, query)
+
 cbeta_tool = Tool(
     name="CBETA經文檢索",
     func=cbeta_tool_func,
+    coroutine=acbeta_tool_func,
     description="根據用戶問題檢索CBETA佛教經典，返回經文與標準引用。"
 )
 
-def get_agent(openai_api_key: str, user_id: Optional[str] = None):
-    """创建一个配置好的LangChain代理，使用CBETA工具"""
-    # 系统提示词基本模板
-    system_message_template = """你是"菩薩小老師"，一位博学的佛法顧問，遵循以下原則：
-
-1. 清晰易懂：用簡單的現代語言解釋佛法概念，避免晦澀的專業術語。
-2. 慈悲為懷：以平等之心對待所有問題，不帶評判。
-3. 實用建議：提供具體、可行的建議，而非抽象理論。
-4. 歷史準確：確保所有引用的經文和歷史信息準確無誤。
-5. 避免宣揚迷信：不傳播未經證實的迷信或神秘說法。
-6. 使用台灣繁體中文：所有回覆必須使用台灣繁體中文，包括詞彙選擇和表達方式都要符合台灣用語習慣。
-
-你的回應應該簡潔明瞭、貼近生活實際，並在適當時引用經典原文佐證。避免使用過於學術化的語言，確保一般大眾能夠理解。
-
-你可以使用CBETA工具來查詢佛教經典中的內容，幫助提供更準確的回答。
-"""
-
-    # 添加用户上下文（如果有用户ID）
-    if user_id:
-        user_context = get_user_context(user_id)
-        if user_context:
-            # 格式化上下文信息
-            context_info = f"""
-用户信息：
-- 修行经验：{user_context.get('practice_history', '未知')}
-- 兴趣领域：{', '.join(user_context.get('interests', ['一般佛法']))}
-- 提及过的主题：{', '.join(user_context.get('mentions', []))}
-
-最近对话历史：
-{get_recent_messages_for_context(user_id)}
-"""
-            system_message_template += context_info
-
-    # 初始化语言模型
-    llm = ChatOpenAI(
-        model="gpt-4-turbo", 
-        temperature=0.7,
-        openai_api_key=openai_api_key
-    )
-    
-    # 初始化CBETA检索工具
-    cbeta_retriever = CBETARetriever()
-    tools = [cbeta_retriever]
-    
-    # 创建提示模板
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_message_template),
-        MessagesPlaceholder(variable_name="chat_history", optional=True),
-        ("human", "{input}")
-    ])
-    
-    # 创建代理
-    agent = create_openai_tools_agent(llm, tools, prompt)
+# 系統提示詞：只保留不變的核心規則（精簡後約為原版一半 token，
+# 每次 LLM 呼叫都省下這筆輸入成本）；用戶個性化上下文經獨立的
+# user_ctx 佔位符逐請求注入，不混入系統提示詞
+SYSTEM_PROMPT = """你是「菩薩小老師」，一位佛法顧問，遵循以下原則：
+1. 清晰易懂：用簡單的現代語言解釋佛法，避免晦澀術語，提供具體可行的建議。
+2. 準確無誤：引用的經文與歷史須準確，不傳播未經證實的迷信說法。
+3. 使用台灣繁體中文：詞彙與表達方式符合台灣用語習慣。
+
+你可以使用CBETA工具查詢佛教經典，幫助提供更準確的回答。"""
+
+# 提示模板在導入時構建一次，所有代理共享
+PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT),
+    MessagesPlaceholder(variable_name="user_ctx", optional=True),
+    MessagesPlaceholder(variable_name="chat_history", optional=True),
+    ("human", "{input}")
+])
+
+def _build_user_ctx_messages(user_id: Optional[str]) -> list:
+    """按用戶構建個性化上下文消息，注入 user_ctx 佔位符。"""
+    if not user_id:
+        return []
+
+    user_context = get_user_context(user_id)
+    if not user_context:
+        return []
+
+    practice_history = user_context.get('practice_history', '')
+    interests = user_context.get('interests', [])
+    mentions = user_context.get('mentions', [])
+    recent_messages = get_recent_messages_for_context(user_id)
+
+    # 全無個性化信息時不注入，回答保持與用戶無關（可寫入共享語義快取）
+    if not (practice_history or interests or mentions or recent_messages):
+        return []
+
+    context_info = f"""用戶信息：
+- 修行經驗：{practice_history or '未知'}
+- 興趣領域：{', '.join(interests) if interests else '一般佛法'}
+- 提及過的主題：{', '.join(mentions)}
+
+最近對話歷史：
+{recent_messages}"""
+    return [SystemMessage(content=context_info)]
+
+def get_agent(openai_api_key: str, user_id: Optional[str] = None, fast: bool = False):
+    """创建一个配置好的LangChain代理，使用CBETA工具。
+
+    fast=True 时使用便宜快速的模型（temperature=0，利于命中 LLM 快取），
+    供快速回覆、新聞省思、禪修指令等高流量分支使用。
+    """
+    # 获取全局共享的语言模型（复用连接池）
+    if fast:
+        llm = _get_llm(openai_api_key, model=FAST_MODEL, temperature=0.0, streaming=False)
+    else:
+        llm = _get_llm(openai_api_key)
+
+    # 获取全局共享的CBETA检索工具（检索器对用户无状态，可安全共享）
+    tools = [_get_cbeta_retriever()]
+
+    # 用户个性化上下文（独立于系统提示词）
+    user_ctx_messages = _build_user_ctx_messages(user_id)
+
+    # 创建代理（提示模板为模块级共享实例）
+    agent = create_openai_tools_agent(llm, tools, PROMPT)
     
     # 创建代理执行器
     agent_executor = AgentExecutor(
         agent=agent,
         tools=tools,
-        verbose=True,
+        verbose=LC_VERBOSE,
         # 禁用内存组件，我们将手动管理聊天历史
         handle_parsing_errors=True
     )
@@ -129,10 +298,15 @@ def get_agent(openai_api_key: str, user_id: Optional[str] = None):
         try:
             # 准备输入
             inputs = {"input": user_input}
-            
+
+            # 注入用户个性化上下文
+            if user_ctx_messages:
+                inputs["user_ctx"] = user_ctx_messages
+
             # 如果有聊天历史，添加到输入
+            # 只保留最近的滑動窗口，避免 prompt 隨對話無限增長
             if chat_history:
-                inputs["chat_history"] = chat_history
+                inputs["chat_history"] = chat_history[-MAX_CHAT_HISTORY_MESSAGES:]
                 
             # 执行代理
             result = agent_executor.invoke(inputs)
@@ -140,5 +314,8 @@ def get_agent(openai_api_key: str, user_id: Optional[str] = None):
         except Exception as e:
             logger.error(f"Agent执行错误: {e}", exc_info=True)
             return "抱歉，我目前遇到了一些技术问题。请稍后再试。"
-    
+
+    # 標記回答是否帶個性化上下文，供調用方決定能否寫入共享快取
+    agent_with_chat_history.personalized = bool(user_ctx_messages)
+
     return agent_with_chat_history
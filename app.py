@@ -2,17 +2,19 @@ import os
 import time
 import re
 import json
+import base64
+import hashlib
+import hmac
 import logging
 import traceback
-import threading
-import queue
+import asyncio
 import uuid
 from datetime import datetime
 from dotenv import load_dotenv
-from flask import Flask, request, abort, jsonify
+from quart import Quart, request, abort, jsonify
 from functools import wraps
 from typing import Dict, Any, Optional, List, Tuple, Union
-from threading import Lock
+from cachetools import TTLCache
 
 # 使用LINE Bot SDK v3
 from linebot.v3 import (
@@ -28,17 +30,18 @@ from linebot.v3.webhooks import (
 )
 from linebot.v3.messaging import (
     Configuration,
-    ApiClient,
-    MessagingApi,
+    AsyncApiClient,
+    AsyncMessagingApi,
     ReplyMessageRequest,
     TextMessage,
     FlexMessage,
     FlexContainer,
     QuickReply,
-    PushMessageRequest
+    PushMessageRequest,
+    ShowLoadingAnimationRequest
 )
 
-from agent import get_agent
+from agent import get_agent, check_semantic_cache, store_semantic_cache
 from quick_replies import (
     generate_quick_replies,
     handle_quick_reply_request,
@@ -49,7 +52,6 @@ from user_context import (
     add_user_question,
     analyze_practice_history,
     extract_mentions_from_text,
-    save_user_feedback,
     update_user_context,
     add_to_chat_history,
     get_chat_history,
@@ -57,46 +59,58 @@ from user_context import (
 )
 from news_module import handle_news_command
 from meditation_module import handle_meditation_command
-from news_retrieval import get_news
-from meditation_guide import get_meditation_guidance
 
 # 加載 .env 文件
 load_dotenv()
 
 # 用戶上下文、畫像與速率限制
-user_agents = {}
-user_last_request_time = {}
-user_profiles = {}
-user_last_topics = {}  # 用於儲存用戶最近的對話主題
-user_chat_histories = {}  # 用於存儲每個用戶的聊天歷史
-user_processing_status = {}  # 用於追蹤用戶消息處理狀態
-message_queues = {}  # 為每個用戶維護一個消息隊列
-processing_locks = {}  # 用户处理锁
-last_processing_time = {}  # 用户上次处理消息的时间
+# 以 TTLCache 取代無界 dict：閒置用戶一小時後被淘汰，其 AgentExecutor
+# 與隊列隨之回收，長時間運行的進程 RSS 因此有上界。
+# 所有訪問都在事件循環線程內，無需額外加鎖。
+USER_CACHE_SIZE = 10_000
+USER_CACHE_TTL = 3600
+
+user_agents = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+user_last_request_time = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+user_profiles = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+user_last_topics = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)  # 用於儲存用戶最近的對話主題
+user_chat_histories = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)  # 用於存儲每個用戶的聊天歷史
+message_queues = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)  # 為每個用戶維護一個消息隊列 (asyncio.Queue)
+llm_last_call_time = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)  # 用户上次LLM呼叫的时间（限速用）
+
+# 每個活躍用戶一個常駐工作任務，順序消費其隊列；任務退出時自行清理，
+# 故此 dict 的大小以活躍用戶數為上界
+worker_tasks = {}
 
 # 限制同一用户消息处理频率的最小间隔（秒）
 MIN_PROCESSING_INTERVAL = 10
 
-# 初始化线程池
-message_processing_thread = None
+# 隊列空置超過此秒數後，常駐工作任務自行退出
+WORKER_IDLE_TIMEOUT = 300
 
 # 載入 LINE Bot 憑證
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# 初始化LINE API客户端
+# 初始化LINE API客户端（异步版本，所有请求共用一个事件循环）
 configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
-api_client = ApiClient(configuration)
-line_bot_api = MessagingApi(api_client)
+api_client = AsyncApiClient(configuration)
+line_bot_api = AsyncMessagingApi(api_client)
 
-app = Flask(__name__)
+app = Quart(__name__)
 
-# 指令模式匹配
-NEWS_PATTERN = re.compile(r'(新聞|時事|政治|經濟|文化|國際|台灣)')
-MEDITATION_PATTERN = re.compile(r'(禪修|六妙門|數息|隨息|止|觀|還|淨)')
-PRACTICE_HISTORY_PATTERN = re.compile(r'(我的修行經驗|我修行了|我學佛|我的佛法背景)')
+# 指令模式匹配：三組路由關鍵詞合併為單一交替式，對訊息只掃描一次。
+# 命中多組時按固定優先級取捨（歷史 > 新聞 > 禪修）——禪修組含
+# 「止/觀/還/淨」等常見單字，若取最左命中，「還有什麼新聞嗎」這類
+# 日常句會被誤路由到禪修分支
+ROUTER_PATTERN = re.compile(
+    r'(?P<hist>我的修行經驗|我修行了|我學佛|我的佛法背景)'
+    r'|(?P<news>新聞|時事|政治|經濟|文化|國際|台灣)'
+    r'|(?P<med>禪修|六妙門|數息|隨息|止|觀|還|淨)'
+)
+ROUTER_PRIORITY = ('hist', 'news', 'med')
 
 # 配置日誌
 logging.basicConfig(
@@ -130,17 +144,26 @@ def retry(max_tries=3, delay=1):
     return decorator
 
 @app.route("/webhook", methods=['POST'])
-def webhook():
+async def webhook():
     # 获取HTTP请求头中的X-Line-Signature字段值
-    signature = request.headers['X-Line-Signature']
+    signature = request.headers.get('X-Line-Signature', '')
 
-    # 获取请求内容
-    body = request.get_data(as_text=True)
-    app.logger.info("Request body: %s", body)
+    # 以bytes讀取請求內容，避免多餘的一次文本解碼
+    body = await request.get_data()
 
-    # 验证签名
+    # 先用OpenSSL加速的HMAC-SHA256快速驗簽，失敗直接400，
+    # 不必進入SDK的解析與二次解碼
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
+    if not hmac.compare_digest(base64.b64encode(digest).decode(), signature):
+        app.logger.error("Invalid signature. Check your channel secret.")
+        abort(400)
+
+    body_text = body.decode('utf-8')
+    app.logger.info("Request body: %s", body_text)
+
+    # 簽名已驗證，交給SDK分發事件
     try:
-        handler.handle(body, signature)
+        handler.handle(body_text, signature)
     except InvalidSignatureError:
         app.logger.error("Invalid signature. Check your channel secret.")
         abort(400)
@@ -149,240 +172,282 @@ def webhook():
 
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
-    """处理用户发送的文本消息"""
+    """处理用户发送的文本消息（在事件循环线程内同步调度异步任务）"""
     user_id = event.source.user_id
     text = event.message.text
     reply_token = event.reply_token
-    
-    # 确保用户有一个消息队列
-    if user_id not in message_queues:
-        message_queues[user_id] = queue.Queue()
-        processing_locks[user_id] = Lock()
-    
-    # 检查用户是否已经有正在处理的消息
-    is_processing = user_processing_status.get(user_id, False)
-    
-    # 检查是否需要限制处理频率
-    current_time = time.time()
-    last_time = last_processing_time.get(user_id, 0)
-    time_since_last = current_time - last_time
-    
-    # 准备队列消息
-    message_id = str(uuid.uuid4())
-    queue_item = (text, reply_token, message_id)
-    
+
+    # 确保用户有一个消息队列；重新寫入以刷新TTL，避免活躍用戶的隊列被淘汰
+    user_queue = message_queues.get(user_id)
+    if user_queue is None:
+        user_queue = asyncio.Queue()
+    message_queues[user_id] = user_queue
+
     # 将消息加入用户队列
-    message_queues[user_id].put(queue_item)
-    
-    # 如果没有正在处理的消息且时间间隔足够，立即回复并开始处理
-    if not is_processing and time_since_last >= MIN_PROCESSING_INTERVAL:
-        # 发送即时回复表示消息已收到
-        send_response_to_user("我已收到您的訊息，正在處理中...", reply_token)
-        
-        # 设置用户状态为正在处理
-        user_processing_status[user_id] = True
-        
-        # 启动异步处理
-        threading.Thread(target=process_user_messages, args=(user_id,)).start()
+    message_id = str(uuid.uuid4())
+    user_queue.put_nowait((text, reply_token, message_id))
+
+    # 发送即时回复；隊列已有積壓時調整措辭
+    if user_queue.qsize() > 1:
+        asyncio.create_task(send_response_to_user("您的上一條訊息還在處理中，新的訊息已加入隊列，請稍候...", reply_token))
     else:
-        # 已有消息正在处理，告知用户消息已加入队列
-        if is_processing:
-            send_response_to_user("您的上一條訊息還在處理中，新的訊息已加入隊列，請稍候...", reply_token)
-        else:
-            send_response_to_user("您發送訊息的頻率過快，消息已加入隊列，請稍候...", reply_token)
-            
-            # 检查是否需要启动新的处理线程
-            if not is_processing:
-                user_processing_status[user_id] = True
-                threading.Thread(target=process_user_messages, args=(user_id,)).start()
-
-def process_user_messages(user_id):
-    """处理用户消息队列"""
+        asyncio.create_task(send_response_to_user("我已收到您的訊息，正在處理中...", reply_token))
+
+    # 確保該用戶有常駐工作任務（任務消費隊列，閒置超時後退出）
+    task = worker_tasks.get(user_id)
+    if task is None or task.done():
+        worker_tasks[user_id] = asyncio.create_task(worker_loop(user_id))
+
+async def worker_loop(user_id):
+    """用戶常駐工作任務：順序消費該用戶的消息隊列。
+
+    每個用戶最多一個任務，消除了舊有「每條消息起一個線程」的競態與
+    線程創建開銷；隊列空置超過 WORKER_IDLE_TIMEOUT 後任務自行退出。
+    """
     try:
-        while not message_queues[user_id].empty():
-            # 获取队列中的下一条消息
-            with processing_locks[user_id]:
-                if message_queues[user_id].empty():
-                    break
-                
-                text, reply_token, message_id = message_queues[user_id].get()
-                
-                # 更新最后处理时间
-                last_processing_time[user_id] = time.time()
-                
-                # 处理消息
-                app.logger.info(f"处理用户 {user_id} 的消息: {text}")
-                
-                try:
-                    # 使用代理处理消息
-                    response = process_user_message(user_id, text)
-                    
-                    # 发送处理结果给用户
-                    push_message_to_user(user_id, response)
-                    
-                except Exception as e:
-                    app.logger.error(f"处理消息时出错: {str(e)}", exc_info=True)
-                    # 发送错误消息
-                    push_message_to_user(user_id, "很抱歉，處理您的訊息時發生錯誤，請稍後再試。")
-                
-                # 等待限制时间，避免消息处理过快
-                time.sleep(MIN_PROCESSING_INTERVAL)
+        while True:
+            user_queue = message_queues.get(user_id)
+            if user_queue is None:
+                break
+
+            try:
+                text, reply_token, message_id = await asyncio.wait_for(
+                    user_queue.get(), timeout=WORKER_IDLE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                break
+
+            # 立即顯示「輸入中」載入動畫，降低用戶等待 LLM 回應的體感延遲
+            await show_loading_animation(user_id)
+
+            # 处理消息
+            app.logger.info(f"处理用户 {user_id} 的消息: {text}")
+
+            try:
+                # 使用代理处理消息
+                response = await process_user_message(user_id, text)
+
+                # 发送处理结果给用户
+                await push_message_to_user(user_id, response)
+
+            except Exception as e:
+                app.logger.error(f"处理消息时出错: {str(e)}", exc_info=True)
+                # 发送错误消息
+                await push_message_to_user(user_id, "很抱歉，處理您的訊息時發生錯誤，請稍後再試。")
+            finally:
+                user_queue.task_done()
     finally:
-        # 处理完成，重置状态
-        user_processing_status[user_id] = False
+        # 任務退出時自行清理註冊表
+        worker_tasks.pop(user_id, None)
+
+async def acquire_llm_rate_slot(user_id):
+    """只對 LLM 呼叫限速：距上次 LLM 呼叫不足間隔時補足等待。
 
-def process_user_message(user_id, text):
+    快取命中、簽名驗證、新聞列表等輕量路徑不經過此函數，立即回應。
+    """
+    now = time.monotonic()
+    last = llm_last_call_time.get(user_id, 0.0)
+    wait = MIN_PROCESSING_INTERVAL - (now - last)
+    if wait > 0:
+        await asyncio.sleep(wait)
+    llm_last_call_time[user_id] = time.monotonic()
+
+async def process_user_message(user_id, text):
     """处理用户消息并返回响应"""
     try:
+        # 單次路由掃描；純ASCII訊息（如數字選擇）不可能命中中文關鍵詞，直接跳過
+        if text.isascii():
+            route = None
+        else:
+            matched_groups = {m.lastgroup for m in ROUTER_PATTERN.finditer(text)}
+            route = next((g for g in ROUTER_PRIORITY if g in matched_groups), None)
+
         # 處理修行歷史記錄
-        if PRACTICE_HISTORY_PATTERN.search(text):
+        if route == 'hist':
             analyze_practice_history(user_id, text)
             return "感謝分享您的修行經驗，我會根據您的背景提供更適合的指導。"
-        
-        # 處理新聞相關命令
-        if NEWS_PATTERN.search(text):
-            response = handle_news_command(user_id, OPENAI_API_KEY, text)
-            
-            # 如果是字典格式，轉換為JSON字符串
+
+        # 處理新聞相關命令（阻塞的外部抓取放到线程池，避免卡住事件循环）
+        if route == 'news':
+            # 反思命令含「新聞」會先命中本分支：反思經 LLM，需先取限速配額；
+            # 純列表請求不經 LLM，保持即時回應
+            if text.startswith("請提供新聞佛教反思："):
+                await acquire_llm_rate_slot(user_id)
+            response = await asyncio.to_thread(handle_news_command, user_id, OPENAI_API_KEY, text)
+
+            # 類型化載荷（Flex消息）直接返回，由發送端分發
             if isinstance(response, dict):
-                return json.dumps(response, ensure_ascii=False)
-            
+                return response
+
             # 添加到聊天历史
             add_to_chat_history(user_id, text, response)
             return response
-        
+
         # 處理禪修相關命令
-        if MEDITATION_PATTERN.search(text):
-            response = handle_meditation_command(user_id, OPENAI_API_KEY, text)
+        if route == 'med':
+            # 除列表/選項查詢外都會生成個性化引導（經 LLM），先取限速配額
+            if not ("列表" in text or "選項" in text or "所有" in text):
+                await acquire_llm_rate_slot(user_id)
+            response = await asyncio.to_thread(handle_meditation_command, user_id, OPENAI_API_KEY, text)
             # 添加到聊天历史
             add_to_chat_history(user_id, text, response)
             return response
-        
+
         # 處理快速回復命令
         if text in QUICK_REPLY_COMMANDS:
-            response = handle_quick_reply_request(text, user_id, OPENAI_API_KEY)
-            
-            # 檢查是否是新聞相關的回覆，可能是字典格式
-            if text.startswith("請給我今日時事佛教省思") or "新聞" in text:
-                if isinstance(response, dict):
-                    return json.dumps(response, ensure_ascii=False)
-            
+            # 禪修引導命令會經 LLM 生成，先取限速配額；新聞列表等輕量命令不限速
+            if QUICK_REPLY_COMMANDS[text] == "MEDITATION_GUIDE":
+                await acquire_llm_rate_slot(user_id)
+            response = await asyncio.to_thread(handle_quick_reply_request, text, user_id, OPENAI_API_KEY)
+
+            # 類型化載荷（Flex消息）直接返回，由發送端分發
+            if isinstance(response, dict):
+                return response
+
             # 添加到聊天历史
             add_to_chat_history(user_id, text, response)
             return response
-        
+
         # 處理新聞選擇 (例如 "1", "2", "3")
         if text.isdigit() and 1 <= int(text) <= 5:
             # 查看上一個消息是否是新聞選項列表
             previous_topic = user_last_topics.get(user_id, "")
             if "請選擇您想要了解的新聞" in previous_topic:
-                response = handle_news_command(user_id, OPENAI_API_KEY, None, text)
+                await acquire_llm_rate_slot(user_id)
+                response = await asyncio.to_thread(handle_news_command, user_id, OPENAI_API_KEY, None, text)
                 # 添加到聊天历史
                 add_to_chat_history(user_id, text, response)
                 return response
-        
+
         # 檢查是否是新聞反思請求
         if text.startswith("請提供新聞佛教反思："):
-            response = handle_news_command(user_id, OPENAI_API_KEY, text)
+            await acquire_llm_rate_slot(user_id)
+            response = await asyncio.to_thread(handle_news_command, user_id, OPENAI_API_KEY, text)
             # 添加到聊天历史
             add_to_chat_history(user_id, text, response)
             return response
-        
-        # 將問題添加到用戶上下文
-        add_user_question(user_id, text)
-        
-        # 提取文本中提及的關鍵詞
-        extract_mentions_from_text(user_id, text)
-        
+
         # 記錄用戶最近的對話主題
         user_last_topics[user_id] = text
-        
+
+        # 上下文簿記寫入、聊天歷史讀取與語義快取查詢互相獨立，
+        # 並行執行讓總延遲取最大者而非相加；add_user_question 內部
+        # 已提取關鍵詞，無需再單獨呼叫 extract_mentions_from_text
+        _, chat_history, cached_response = await asyncio.gather(
+            asyncio.to_thread(add_user_question, user_id, text),
+            asyncio.to_thread(get_chat_history, user_id),
+            asyncio.to_thread(check_semantic_cache, f"agent:{text}"),
+        )
+
+        # 語義快取：同義問題直接命中舊答案，跳過整個代理流程
+        # （鍵只含問題本身，避免聊天歷史污染快取鍵）
+        if cached_response is not None:
+            add_to_chat_history(user_id, text, cached_response)
+            return cached_response
+
         # 獲取或初始化用戶的代理
         if user_id not in user_agents:
             user_agents[user_id] = get_agent(OPENAI_API_KEY, user_id)
-        
+
         # 使用代理處理消息
         agent = user_agents[user_id]
-        
-        # 获取聊天历史记录
-        chat_history = get_chat_history(user_id)
-        
+
+        # 自由問答分支必經 LLM，先取得限速配額
+        await acquire_llm_rate_slot(user_id)
+
         # 如果没有聊天历史记录，直接使用代理处理
         if not chat_history:
-            response = agent(text)
+            response = await asyncio.to_thread(agent, text)
         else:
             # 将聊天历史记录转换为LangChain消息格式
             langchain_chat_history = []
             for chat in chat_history:
                 langchain_chat_history.append({"type": "human", "content": chat["user_message"]})
                 langchain_chat_history.append({"type": "ai", "content": chat["bot_response"]})
-            
+
             # 使用带有聊天历史的代理处理
-            response = agent(text, langchain_chat_history)
-        
+            response = await asyncio.to_thread(agent, text, langchain_chat_history)
+
         # 添加到聊天历史
         add_to_chat_history(user_id, text, response)
-        
+
+        # 寫入語義快取，供後續同義問題使用。個性化回答不入共享快取：
+        # 語義快取按向量相似度匹配，鍵裡混入用戶ID無法可靠隔離，
+        # 寫入會把該用戶的修行背景洩漏給提出相似問題的其他用戶
+        if not getattr(agent, "personalized", False):
+            store_semantic_cache(f"agent:{text}", response)
+
         # 返回回答
         return response
-            
+
     except Exception as e:
         app.logger.error(f"處理用戶消息異常: {str(e)}", exc_info=True)
         return "很抱歉，處理您的請求時發生錯誤。請稍後再試。"
 
-def send_response_to_user(text, reply_token):
+async def show_loading_animation(user_id, seconds=30):
+    """在用戶聊天室顯示LINE載入動畫（盡力而為，失敗不影響主流程）"""
+    try:
+        await line_bot_api.show_loading_animation(
+            ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=seconds)
+        )
+    except Exception as e:
+        app.logger.debug(f"顯示載入動畫失敗: {e}")
+
+def build_line_message(payload):
+    """將內部回覆載荷轉為LINE消息物件。
+
+    dict 為類型化載荷（{"type": "flex", "contents": ...} 或
+    {"type": "text", "text": ...}），直接分發，無需序列化往返；
+    str 維持舊行為：形如JSON時嘗試解析為Flex，否則作純文本。
+    """
+    if isinstance(payload, dict):
+        if payload.get("type") == "flex":
+            return FlexMessage(
+                alt_text=payload.get("altText", "回覆內容"),
+                contents=FlexContainer.from_dict(payload["contents"])
+            )
+        return TextMessage(text=payload.get("text", ""))
+
+    if payload.startswith("{") and payload.endswith("}"):
+        # 向後相容：字串形式的JSON仍嘗試解析為Flex
+        try:
+            flex_data = json.loads(payload)
+            flex_container = FlexContainer.from_dict(flex_data)
+            return FlexMessage(alt_text="回覆內容", contents=flex_container)
+        except:
+            pass
+
+    return TextMessage(text=payload)
+
+async def send_response_to_user(payload, reply_token):
     """使用reply API发送消息回复用户"""
     try:
-        # 檢查回覆類型
-        if text.startswith("{") and text.endswith("}"):
-            # 嘗試解析為JSON (Flex消息)
-            try:
-                flex_data = json.loads(text)
-                flex_container = FlexContainer.from_dict(flex_data)
-                message = FlexMessage(alt_text="回覆內容", contents=flex_container)
-            except:
-                # 如果解析失敗，作為普通文本發送
-                message = TextMessage(text=text)
-        else:
-            # 普通文本消息
-            message = TextMessage(text=text)
-            
+        message = build_line_message(payload)
+
         # 通過LINE Reply API發送消息
         reply_request = ReplyMessageRequest(
             reply_token=reply_token,
             messages=[message]
         )
-        line_bot_api.reply_message(reply_request)
+        await line_bot_api.reply_message(reply_request)
         app.logger.info(f"已發送回覆給用戶 {reply_token}")
-        
+
     except Exception as e:
         app.logger.error(f"發送回覆給用戶失敗: {str(e)}", exc_info=True)
 
-def push_message_to_user(user_id, text):
+async def push_message_to_user(user_id, payload):
     """使用push API发送消息给用户"""
     try:
-        # 檢查回覆類型
-        if text.startswith("{") and text.endswith("}"):
-            # 嘗試解析為JSON (Flex消息)
-            try:
-                flex_data = json.loads(text)
-                flex_container = FlexContainer.from_dict(flex_data)
-                message = FlexMessage(alt_text="回覆內容", contents=flex_container)
-            except:
-                # 如果解析失敗，作為普通文本發送
-                message = TextMessage(text=text)
-        else:
-            # 普通文本消息
-            message = TextMessage(text=text)
-            
+        message = build_line_message(payload)
+
         # 通過LINE Push API發送消息
         push_request = PushMessageRequest(
             to=user_id,
             messages=[message]
         )
-        line_bot_api.push_message(push_request)
+        await line_bot_api.push_message(push_request)
         app.logger.info(f"已發送回覆給用戶 {user_id}")
-        
+
     except Exception as e:
         app.logger.error(f"發送回覆給用戶失敗: {str(e)}", exc_info=True)
 
@@ -391,12 +456,12 @@ def handle_follow(event):
     """处理用户关注事件"""
     user_id = event.source.user_id
     welcome_message = "感恩您的關注！我是「菩薩小老師」，一位融合佛教智慧的數位助手。我能協助您理解佛法在日常生活中的應用，提供心靈平靜與智慧的指導。請隨時向我提問，我將盡力以佛法智慧為您解答。祝願您身心安康，福慧增長！🙏"
-    
+
     reply_token = event.reply_token
-    send_response_to_user(welcome_message, reply_token)
+    asyncio.create_task(send_response_to_user(welcome_message, reply_token))
 
 @app.route("/health", methods=['GET'])
-def health_check():
+async def health_check():
     """健康检查端点"""
     return jsonify({
         "status": "ok",
@@ -406,7 +471,8 @@ def health_check():
 if __name__ == "__main__":
     port = int(os.getenv('PORT', 8080))
     try:
+        import uvicorn
         app.logger.info(f"啟動應用服務器，端口: {port}")
-        app.run(host='0.0.0.0', port=port)
+        uvicorn.run(app, host='0.0.0.0', port=port)
     except Exception as e:
         app.logger.critical(f"應用啟動失敗: {str(e)}", exc_info=True)
@@ -0,0 +1,595 @@
+"""CBETA 语料共享索引。
+
+CBETARetriever 与 CBETASearcher 过去各自加载语料、各自编码一份嵌入矩阵，
+内存与启动编码成本都翻倍。本模块把段落、倒排索引与嵌入矩阵收敛到一个
+进程级单例，两个工具包装器只持有引用；嵌入矩阵经 mmap 打开，多个 worker
+进程通过 OS 页缓存共享同一份物理内存。
+"""
+import functools
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# orjson 解码比标准库快数倍且解码期间释放 GIL，缺少时回退标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# CBETA 数据目录
+CBETA_DIR = os.path.join(os.path.dirname(__file__), 'data', 'cbeta')
+
+# 预先导出的 ONNX 查询编码器目录（可选）：
+#   optimum-cli export onnx --model paraphrase-multilingual-MiniLM-L12-v2 \
+#       --task feature-extraction data/onnx_model
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(__file__), 'data', 'onnx_model')
+
+# 查询嵌入缓存容量：快速回复等固定查询字串跨用户高频重复，
+# 命中时省去一次完整的编码器前向
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# 段落分割正则：模块级预编译一次，初始化时处理成千上万篇文档
+# 免去每次调用的 re 缓存查找
+_PARA_RE = re.compile(r'\n\s*\n')
+_SENT_RE = re.compile(r'([。？！][\s\n]+)')
+
+
+class CBETAIndex:
+    """持有 CBETA 语料的段落、倒排索引与嵌入矩阵的共享索引。"""
+
+    def __init__(self, cbeta_dir: str = CBETA_DIR):
+        self.cbeta_dir = cbeta_dir
+        self.docs = self._load_documents()
+
+        # 预处理段落
+        self._preprocess_paragraphs()
+        logger.info(f"已加载 {len(self.para_contents)} 个经文段落")
+
+        # 字符二元组倒排索引：关键词检索免去全量段落扫描
+        self.token_index = self._build_token_index()
+
+        # TF-IDF 稀疏评分统计量，与稠密余弦融合做混合检索
+        self._build_sparse_stats()
+
+        # 初始化语义搜索
+        self.embeddings = None
+        self.model = None
+        self.query_embedding_cache = {}
+
+        # ONNX int8 查询编码器（可选），失败后不再重试
+        self._onnx_session = None
+        self._onnx_tokenizer = None
+        self._onnx_disabled = False
+        self.has_embedding = self._setup_embedding_search()
+
+        # 可选的 ANN 近似索引：大语料的检索从 O(N·D) 降到近似 O(log N)
+        self.ann_index = self._setup_ann_index() if self.has_embedding else None
+
+        if self.has_embedding:
+            logger.info("语义搜索索引就绪")
+        else:
+            logger.warning("仅使用关键词搜索")
+
+    # ---------- 语料加载与预处理 ----------
+
+    def _load_one_document(self, path: str) -> Optional[Dict]:
+        """加载单个 JSON 文档，失败时返回 None。"""
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            return orjson.loads(raw) if orjson is not None else json.loads(raw)
+        except Exception as e:
+            logger.error(f"加载文件 {os.path.basename(path)} 时出错: {e}")
+            return None
+
+    def _load_documents(self) -> List[Dict]:
+        """加载所有CBETA JSON文档。"""
+        try:
+            # os.scandir 免去逐文件的额外 stat 调用；排序保证段落顺序
+            # （及嵌入缓存键）在不同文件系统上稳定
+            with os.scandir(self.cbeta_dir) as it:
+                files = sorted(e.path for e in it if e.name.endswith('.json'))
+
+            # 线程池并行加载，磁盘 I/O 与 JSON 解码相互重叠
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                docs = [d for d in executor.map(self._load_one_document, files)
+                        if d is not None]
+
+            logger.info(f"成功加载 {len(docs)} 个CBETA文档")
+            return docs
+        except Exception as e:
+            logger.error(f"加载CBETA文档时出错: {e}")
+            return []
+
+    def _preprocess_paragraphs(self) -> None:
+        """将经文分割成段落，以 SoA（并行列数组）形式存储。
+
+        list-of-dict 每段带数百字节的字典开销，且 doc_id/title 字符串在
+        同一部经的所有段落间重复；改存并行数组后这些字符串每部经只存
+        一份，检索扫描也变成对紧凑列表的顺序访问。段落字典只在最终
+        top-k 结果上按需物化（见 _make_paragraph）。
+        """
+        self.doc_id_table = []
+        self.title_table = []
+        self.para_contents = []
+        doc_indices = []
+        para_indices = []
+
+        for doc_idx, doc in enumerate(self.docs):
+            self.doc_id_table.append(doc.get('id', ''))
+            self.title_table.append(doc.get('title', ''))
+
+            # 分割段落
+            content = doc.get('content', '')
+            for idx, para in enumerate(self._split_text_to_paragraphs(content)):
+                para = para.strip()
+                if not para:
+                    continue
+                self.para_contents.append(para)
+                doc_indices.append(doc_idx)
+                para_indices.append(idx)
+
+        self.para_doc_idx = np.array(doc_indices, dtype=np.int32)
+        self.para_index_in_doc = np.array(para_indices, dtype=np.int32)
+
+    def _make_paragraph(self, idx: int) -> Dict:
+        """按需物化单个段落字典，仅对最终 top-k 结果调用。"""
+        doc_idx = int(self.para_doc_idx[idx])
+        doc_id = self.doc_id_table[doc_idx]
+        para_idx = int(self.para_index_in_doc[idx])
+        return {
+            'id': f"{doc_id}_p{para_idx}",
+            'doc_id': doc_id,
+            'title': self.title_table[doc_idx],
+            'content': self.para_contents[idx],
+            'paragraph_index': para_idx
+        }
+
+    @property
+    def paragraphs(self) -> List[Dict]:
+        """兼容属性：物化全部段落字典。检索热路径不再使用。"""
+        return [self._make_paragraph(i) for i in range(len(self.para_contents))]
+
+    def _split_text_to_paragraphs(self, text: str) -> List[str]:
+        """智能分割文本为自然段落。"""
+        # 首先尝试按照空行分割
+        paragraphs = _PARA_RE.split(text)
+
+        # 如果只有一个段落，尝试按照句号等标点符号分割
+        if len(paragraphs) <= 1:
+            # 以句号、问号或感叹号后跟换行或空格为分隔点
+            paragraphs = _SENT_RE.split(text)
+
+            # 合并标点与内容
+            processed_paragraphs = []
+            for i in range(0, len(paragraphs), 2):
+                if i + 1 < len(paragraphs):
+                    processed_paragraphs.append(paragraphs[i] + paragraphs[i + 1])
+                else:
+                    processed_paragraphs.append(paragraphs[i])
+
+            paragraphs = processed_paragraphs
+
+        # 过滤空段落
+        paragraphs = [p for p in paragraphs if p.strip()]
+
+        return paragraphs
+
+    # ---------- 倒排索引与稀疏评分 ----------
+
+    def _build_token_index(self) -> Dict[str, set]:
+        """建立字符二元组 → 段落索引的倒排索引。
+
+        中文无空格分词，字符 bigram 是最稳的退化分词；任何包含查询子串的
+        段落必然包含查询的所有 bigram，可据此先求交集缩小候选集。
+        """
+        index: Dict[str, set] = {}
+        for idx, content in enumerate(self.para_contents):
+            for i in range(len(content) - 1):
+                index.setdefault(content[i:i + 2], set()).add(idx)
+        return index
+
+    def _candidate_indices(self, text: str) -> set:
+        """交集 text 所有 bigram 的 posting list，返回可能命中的段落索引。"""
+        if len(text) < 2:
+            # 单字查询无 bigram 可查，退回全量候选
+            return set(range(len(self.para_contents)))
+        postings = []
+        for i in range(len(text) - 1):
+            posting = self.token_index.get(text[i:i + 2])
+            if posting is None:
+                return set()
+            postings.append(posting)
+        # 从最短的 posting list 开始交集，提前清空就提前返回
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting
+            if not candidates:
+                break
+        return candidates
+
+    def _build_sparse_stats(self) -> None:
+        """预计算 TF-IDF 稀疏评分所需的词频与逆文档频率。"""
+        self.para_tf = []
+        for content in self.para_contents:
+            tf = {}
+            for i in range(len(content) - 1):
+                gram = content[i:i + 2]
+                tf[gram] = tf.get(gram, 0) + 1
+            self.para_tf.append(tf)
+
+        n_docs = len(self.para_contents)
+        self.idf = {
+            token: math.log((n_docs + 1) / (len(postings) + 1)) + 1.0
+            for token, postings in self.token_index.items()
+        }
+
+    def _sparse_scores(self, query: str) -> Dict[int, float]:
+        """在倒排索引候选集上计算 TF-IDF 得分，返回 段落索引 → 得分。
+
+        只触碰与查询共享 bigram 的段落，代价与候选数而非语料规模成正比。
+        """
+        grams = [query[i:i + 2] for i in range(len(query) - 1)]
+        scores: Dict[int, float] = {}
+        for gram in grams:
+            idf = self.idf.get(gram)
+            if idf is None:
+                continue
+            for idx in self.token_index[gram]:
+                scores[idx] = scores.get(idx, 0.0) + idf * self.para_tf[idx].get(gram, 0)
+        return scores
+
+    # ---------- 语义搜索 ----------
+
+    def _embedding_cache_path(self) -> str:
+        """按段落内容哈希生成嵌入缓存文件路径，语料变动自动失效。"""
+        key = hashlib.sha256(
+            json.dumps([
+                f"{self.doc_id_table[int(d)]}_p{int(p)}{c}"
+                for d, p, c in zip(self.para_doc_idx, self.para_index_in_doc,
+                                   self.para_contents)
+            ]).encode()
+        ).hexdigest()[:16]
+        return os.path.join(self.cbeta_dir, f'embeddings_{key}.npy')
+
+    def _get_model(self):
+        """延迟加载编码器：命中磁盘缓存的热启动在首次查询前不触碰 torch。"""
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+            # 使用多语言模型，支持中文
+            self.model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+        return self.model
+
+    def _setup_embedding_search(self) -> bool:
+        """设置语义搜索功能。"""
+        try:
+            # 磁盘缓存命中时直接 mmap 加载：启动变为 O(1)，
+            # 多个 worker 进程共享同一份页缓存
+            cache_path = self._embedding_cache_path()
+            if os.path.exists(cache_path):
+                self.embeddings = np.load(cache_path, mmap_mode='r')
+                logger.info(f"从缓存加载 {len(self.embeddings)} 个嵌入向量")
+                return True
+
+            import torch
+
+            model = self._get_model()
+
+            # 为所有段落生成嵌入向量
+            logger.info("开始生成段落嵌入向量...")
+
+            contents = self.para_contents
+
+            # smart-batching：按长度排序后编码，同批段落长度相近，
+            # padding token 的浪费最少；编码后再还原原始顺序
+            order = sorted(range(len(contents)), key=lambda i: len(contents[i]))
+
+            # 大批次 + 张量全程留在设备上，最后一次性拷回主机；
+            # normalize_embeddings=True 由编码器顺带做 L2 归一化，
+            # 余弦相似度退化为一次纯点积 gemv
+            sorted_embeddings = model.encode(
+                [contents[i] for i in order],
+                batch_size=256,
+                show_progress_bar=True,
+                convert_to_tensor=True,
+                normalize_embeddings=True,
+                device='cuda' if torch.cuda.is_available() else 'cpu'
+            ).cpu().numpy()
+
+            embeddings = np.empty_like(sorted_embeddings)
+            embeddings[order] = sorted_embeddings
+
+            # 以 float16 存储嵌入矩阵：内存与相似度计算的带宽减半，
+            # 384 维句向量的排序质量几乎不受影响
+            self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float16)
+
+            # 持久化后重新以 mmap 打开，与热启动路径保持一致
+            np.save(cache_path, self.embeddings)
+            self.embeddings = np.load(cache_path, mmap_mode='r')
+
+            logger.info(f"成功生成 {len(self.embeddings)} 个嵌入向量")
+            return True
+
+        except ImportError as e:
+            logger.warning(f"无法导入sentence-transformers: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"设置嵌入搜索时出错: {e}")
+            return False
+
+    def _setup_ann_index(self):
+        """构建或加载 faiss HNSW 近似最近邻索引，faiss 缺失时返回 None。
+
+        向量已归一化，用内积度量即余弦相似度；索引持久化在嵌入缓存旁，
+        与 .npy 共用内容哈希键。
+        """
+        try:
+            import faiss
+        except ImportError:
+            return None
+
+        try:
+            ann_path = self._embedding_cache_path().replace('.npy', '.faiss')
+            if os.path.exists(ann_path):
+                logger.info("从缓存加载 faiss 索引")
+                return faiss.read_index(ann_path)
+
+            dim = int(self.embeddings.shape[1])
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+            index.add(np.ascontiguousarray(self.embeddings, dtype=np.float32))
+            faiss.write_index(index, ann_path)
+            logger.info(f"已构建 faiss HNSW 索引（{index.ntotal} 个向量）")
+            return index
+        except Exception as e:
+            logger.warning(f"无法构建 faiss 索引，保持暴力检索: {e}")
+            return None
+
+    def _get_onnx_encoder(self):
+        """加载 int8 量化的 ONNX 查询编码器，不可用时返回 None。
+
+        查询编码是每次工具调用的主要延迟来源；动态 int8 量化在 CPU 上
+        通常带来 2-4 倍加速。模型需预先导出（见 ONNX_MODEL_DIR 注释），
+        int8 版本首次使用时自动量化并持久化。语料的一次性编码仍走
+        PyTorch 路径。
+        """
+        if self._onnx_session is not None:
+            return self._onnx_session, self._onnx_tokenizer
+        if self._onnx_disabled:
+            return None
+
+        model_path = os.path.join(ONNX_MODEL_DIR, 'model.onnx')
+        if not os.path.exists(model_path):
+            self._onnx_disabled = True
+            return None
+
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+
+            int8_path = os.path.join(ONNX_MODEL_DIR, 'model_int8.onnx')
+            if not os.path.exists(int8_path):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantize_dynamic(model_path, int8_path, weight_type=QuantType.QInt8)
+                logger.info("已生成 int8 量化的 ONNX 查询编码器")
+
+            self._onnx_session = ort.InferenceSession(
+                int8_path, providers=['CPUExecutionProvider']
+            )
+            self._onnx_tokenizer = AutoTokenizer.from_pretrained(ONNX_MODEL_DIR)
+            logger.info("已启用 ONNX int8 查询编码器")
+            return self._onnx_session, self._onnx_tokenizer
+        except Exception as e:
+            logger.warning(f"无法加载 ONNX 查询编码器，回退 PyTorch: {e}")
+            self._onnx_disabled = True
+            return None
+
+    def _encode_query_onnx(self, query: str) -> Optional[np.ndarray]:
+        """用 ONNX 会话编码查询：tokenize → 前向 → mean-pool → L2 归一化。"""
+        encoder = self._get_onnx_encoder()
+        if encoder is None:
+            return None
+
+        session, tokenizer = encoder
+        inputs = tokenizer([query], return_tensors='np', padding=True, truncation=True)
+        input_names = {i.name for i in session.get_inputs()}
+        hidden = session.run(
+            None, {k: v for k, v in inputs.items() if k in input_names}
+        )[0]
+
+        # attention mask 加权的 mean-pooling，与 sentence-transformers 一致
+        mask = inputs['attention_mask'][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        vec = pooled[0]
+        norm = float(np.linalg.norm(vec))
+        if norm:
+            vec = vec / norm
+        return vec.astype(np.float16)
+
+    def _encode_query(self, query: str) -> np.ndarray:
+        """编码查询为嵌入向量，重复查询直接命中缓存。"""
+        cached = self.query_embedding_cache.get(query)
+        if cached is not None:
+            return cached
+
+        # 优先走 int8 ONNX 编码器，不可用时回退 PyTorch
+        vec = self._encode_query_onnx(query)
+        if vec is None:
+            vec = self._get_model().encode(
+                [query], normalize_embeddings=True, convert_to_numpy=True
+            )[0].astype(np.float16)
+
+        # 简单的FIFO淘汰，保证缓存有界
+        if len(self.query_embedding_cache) >= QUERY_EMBEDDING_CACHE_SIZE:
+            self.query_embedding_cache.pop(next(iter(self.query_embedding_cache)))
+        self.query_embedding_cache[query] = vec
+        return vec
+
+    def search_by_embedding(self, query: str, top_k: int = 5) -> List[Dict]:
+        """使用语义搜索查找与查询最相关的段落。"""
+        # 生成查询的嵌入向量（带缓存）
+        query_embedding = self._encode_query(query)
+        sparse = self._sparse_scores(query)
+
+        if self.ann_index is not None:
+            top = self._ann_topk(query_embedding, sparse, top_k)
+        else:
+            top = self._brute_topk(query_embedding, sparse, top_k)
+
+        # 只为最终 top-k 结果物化段落字典，并附相似度分数
+        results = []
+        for idx, score in top:
+            para = self._make_paragraph(idx)
+            para['similarity'] = score
+            results.append(para)
+
+        return results
+
+    def _brute_topk(self, query_embedding, sparse: Dict[int, float],
+                    top_k: int) -> List[tuple]:
+        """全量 gemv 打分后取 top-k，返回 (段落索引, 融合得分) 列表。"""
+        # 两侧均已归一化，余弦相似度就是一次纯点积；
+        # einsum 指定 float32 累加：存储保持 float16，计算不损失精度
+        similarities = np.einsum('ij,j->i', self.embeddings, query_embedding, dtype=np.float32)
+
+        # 混合检索：稀疏 TF-IDF 与稠密余弦各占一半权重，
+        # 字面命中与语义相近互补，提升召回
+        if sparse:
+            min_s = min(sparse.values())
+            span = max(sparse.values()) - min_s
+            # 余弦从 [-1,1] 归一到 [0,1]，与 min-max 后的稀疏分同尺度
+            similarities = 0.5 * (similarities + 1.0) / 2.0
+            for idx, score in sparse.items():
+                normalized = (score - min_s) / span if span else 1.0
+                similarities[idx] += 0.5 * normalized
+
+        # 获取相似度最高的前 top_k 个段落
+        # argpartition 做 O(N) 选择，只对 k 个幸存者排序，免去全量 O(N log N) 排序
+        k = min(top_k, similarities.shape[0])
+        candidate_indices = np.argpartition(-similarities, k - 1)[:k]
+        top_indices = candidate_indices[np.argsort(-similarities[candidate_indices])]
+        return [(int(i), float(similarities[i])) for i in top_indices]
+
+    def _ann_topk(self, query_embedding, sparse: Dict[int, float],
+                  top_k: int) -> List[tuple]:
+        """经 ANN 索引召回稠密候选后融合稀疏得分，返回 (索引, 得分) 列表。
+
+        稀疏候选中未被 ANN 召回的，按行精确补算点积（候选数远小于语料），
+        保证字面强命中不会被近似召回漏掉。
+        """
+        q32 = np.ascontiguousarray(query_embedding, dtype=np.float32)
+
+        # 多召回一些稠密候选，给稀疏融合留出重排空间
+        k_ann = min(max(top_k * 4, 32), len(self.para_contents))
+        scores, ids = self.ann_index.search(q32[None, :], k_ann)
+        dense = {int(i): float(s) for s, i in zip(scores[0], ids[0]) if i >= 0}
+
+        for idx in sparse:
+            if idx not in dense:
+                dense[idx] = float(self.embeddings[idx].astype(np.float32) @ q32)
+
+        if sparse:
+            min_s = min(sparse.values())
+            span = max(sparse.values()) - min_s
+            fused = {}
+            for idx, d in dense.items():
+                score = 0.5 * (d + 1.0) / 2.0
+                if idx in sparse:
+                    score += 0.5 * ((sparse[idx] - min_s) / span if span else 1.0)
+                fused[idx] = score
+        else:
+            fused = dense
+
+        top = sorted(fused.items(), key=lambda kv: -kv[1])[:top_k]
+        return [(idx, score) for idx, score in top]
+
+    def search_by_keywords(self, query: str, top_k: int = 5) -> List[Dict]:
+        """使用关键词搜索查找包含查询词的段落。"""
+        results = []
+
+        # 分词
+        query_words = query.split()
+
+        # 完全匹配搜索：倒排索引先缩小候选集，只对幸存者做精确验证；
+        # 完全匹配优先级最高，凑满 top_k 即可提前返回
+        full_match_idx = set()
+        for idx in sorted(self._candidate_indices(query)):
+            if query in self.para_contents[idx]:
+                para = self._make_paragraph(idx)
+                para['match_type'] = 'full'
+                results.append(para)
+                full_match_idx.add(idx)
+                if len(results) >= top_k:
+                    return results[:top_k]
+
+        # 部分匹配候选（各查询词候选的并集），剔除已命中的完全匹配
+        partial_candidates = set()
+        for word in query_words:
+            partial_candidates |= self._candidate_indices(word)
+        partial_candidates -= full_match_idx
+
+        def _partial_matches():
+            for idx in partial_candidates:
+                # 检查是否有足够的查询词匹配
+                content = self.para_contents[idx]
+                matched_words = sum(1 for word in query_words if word in content)
+                if matched_words >= max(1, len(query_words) // 2):
+                    yield idx, matched_words
+
+        # heapq.nlargest 对候选流做 O(N log k) 部分排序，
+        # 段落字典只为最终入选者物化
+        need = top_k - len(results)
+        if need > 0:
+            for idx, matched_words in heapq.nlargest(
+                    need, _partial_matches(), key=lambda t: t[1]):
+                para = self._make_paragraph(idx)
+                para['match_type'] = 'partial'
+                para['matched_words'] = matched_words
+                results.append(para)
+
+        return results
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict]:
+        """统一检索入口：优先语义搜索，失败或不可用时回退关键词搜索。"""
+        if self.has_embedding:
+            try:
+                return self.search_by_embedding(query, top_k)
+            except Exception as e:
+                logger.error(f"语义搜索失败，回退关键词搜索: {e}")
+        return self.search_by_keywords(query, top_k)
+
+    def format_reference(self, doc: Dict) -> str:
+        """生成标准的CBETA引用格式。"""
+        doc_id = doc.get('doc_id', doc.get('id', ''))
+        title = doc.get('title', '')
+
+        # 如果标题为空，查找原始文档获取
+        if not title and doc_id:
+            for original_doc in self.docs:
+                if original_doc.get('id', '') == doc_id:
+                    title = original_doc.get('title', '')
+                    break
+
+        # 生成CBETA在线链接
+        url = f'https://cbetaonline.dila.edu.tw/zh/{doc_id}'
+
+        # 格式化引用
+        reference = f"{title}（CBETA编号：{doc_id}）\n{url}"
+        return reference
+
+
+@functools.lru_cache(maxsize=None)
+def get_index(cbeta_dir: str = CBETA_DIR) -> CBETAIndex:
+    """进程级单例工厂：同一数据目录只建一份索引。"""
+    return CBETAIndex(cbeta_dir)
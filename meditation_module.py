@@ -1,7 +1,15 @@
 import random
+import re
 from typing import Dict, Optional, List
 from agent import get_agent
 
+# 修行年資正則：模塊級預編譯一次，每個禪修命令都會用到
+_YEARS_RE = re.compile(r'(\d+)\s*年')
+
+# 判定修行級別用的概念詞表：模塊級常量，免去每次調用重建列表
+_ADVANCED_CONCEPTS = ("無我", "空性", "實相", "涅槃", "般若", "中道", "如來藏")
+_INTERMEDIATE_CONCEPTS = ("止觀", "定慧", "禪定", "三學", "七覺支", "八正道")
+
 # 六妙門原文出處
 SIX_WONDERFUL_GATES_SOURCE = "《六妙法門》為天台宗智者大師所著，提出了數息、隨息、止、觀、還、淨六種修行方法。"
 
@@ -118,21 +126,15 @@ def determine_user_level(user_context: Dict = None) -> str:
     questions = user_context.get('questions', [])
     practice_history = user_context.get('practice_history', '')
     
-    # 檢查高級修行概念的提及
-    advanced_concepts = ["無我", "空性", "實相", "涅槃", "般若", "中道", "如來藏"]
-    intermediate_concepts = ["止觀", "定慧", "禪定", "三學", "七覺支", "八正道"]
-    
-    # 計算提及高級概念的數量
-    advanced_count = sum(1 for concept in advanced_concepts if any(concept in m for m in mentions))
-    intermediate_count = sum(1 for concept in intermediate_concepts if any(concept in m for m in mentions))
+    # 計算提及高級概念的數量：先把 mentions 拼成一個字串，
+    # 每個概念只做一次子串掃描，免去 概念數×提及數 的嵌套掃描
+    joined = '\n'.join(mentions)
+    advanced_count = sum(1 for concept in _ADVANCED_CONCEPTS if concept in joined)
+    intermediate_count = sum(1 for concept in _INTERMEDIATE_CONCEPTS if concept in joined)
     
     # 檢查實踐歷史中的關鍵詞
-    years_match = None
-    import re
-    if practice_history:
-        years_pattern = re.compile(r'(\d+)\s*年')
-        years_match = years_pattern.search(practice_history)
-    
+    years_match = _YEARS_RE.search(practice_history) if practice_history else None
+
     practice_years = 0
     if years_match:
         try:
@@ -172,18 +174,14 @@ def generate_meditation_guide(user_id: str, openai_api_key: str, user_context: D
         selected_gate = random.choice(suitable_practices)
     
     practice_info = SIX_GATES[selected_gate]
-    
-    # 基本引導內容
-    basic_guide = (f"【{selected_gate}禪修引導】\n\n"
-                   f"{practice_info['description']}\n\n"
-                   f"修行方法：\n" + 
-                   "\n".join([f"{i+1}. {step}" for i, step in enumerate(practice_info['instructions'])]) +
-                   f"\n\n引自六妙門：「{practice_info['quote']}」")
+
+    # 基本引導內容：模塊導入時已預先格式化，這裡只做字典查找
+    basic_guide = _BASIC_GUIDES[selected_gate]
     
     # 如果有 API 密鑰，使用 AI 生成個性化引導
     if openai_api_key:
         try:
-            agent = get_agent(openai_api_key, 'meditation_guide')
+            agent = get_agent(openai_api_key, 'meditation_guide', fast=True)
             
             # 準備用戶背景信息
             user_background = ""
@@ -193,7 +191,8 @@ def generate_meditation_guide(user_id: str, openai_api_key: str, user_context: D
                 if 'practice_history' in user_context:
                     user_background += f"\n修行經驗: {user_context['practice_history']}"
                 if 'questions' in user_context:
-                    recent_questions = user_context['questions'][-3:] if len(user_context['questions']) > 0 else []
+                    # questions 是帶 maxlen 的 deque，切片前先轉回 list
+                    recent_questions = list(user_context['questions'])[-3:]
                     if recent_questions:
                         user_background += f"\n最近提問: {', '.join(recent_questions)}"
             
@@ -210,7 +209,7 @@ def generate_meditation_guide(user_id: str, openai_api_key: str, user_context: D
                       f"5. 如何將此修行融入日常生活\n\n"
                       f"整體內容簡潔明了，易於理解和實踐。")
             
-            personalized_guide = agent.run(prompt)
+            personalized_guide = agent(prompt)
             return f"【{selected_gate}禪修引導】\n\n{personalized_guide}\n\n參考出處：{SIX_WONDERFUL_GATES_SOURCE}"
         except Exception as e:
             print(f"生成個性化禪修引導失敗: {e}")
@@ -221,14 +220,25 @@ def generate_meditation_guide(user_id: str, openai_api_key: str, user_context: D
 
 def list_meditation_options() -> str:
     """列出所有禪修選項"""
-    options = ["六妙門禪修法門："]
-    
-    for gate, info in SIX_GATES.items():
-        options.append(f"【{gate}】- {info['description'][:30]}... (適合{info['level']})")
-    
-    options.append("\n請輸入「禪修指導：數息」等命令來獲取特定引導。")
-    
-    return "\n\n".join(options)
+    return _OPTIONS_STR
+
+def _format_basic_guide(gate: str, info: Dict) -> str:
+    """格式化單個法門的基本引導文本。"""
+    steps = "\n".join(f"{i+1}. {step}" for i, step in enumerate(info['instructions']))
+    return (f"【{gate}禪修引導】\n\n"
+            f"{info['description']}\n\n"
+            f"修行方法：\n{steps}"
+            f"\n\n引自六妙門：「{info['quote']}」")
+
+# SIX_GATES 是不變的模塊級數據，基本引導與選項列表在導入時
+# 各格式化一次，請求路徑只剩字典查找
+_BASIC_GUIDES = {gate: _format_basic_guide(gate, info) for gate, info in SIX_GATES.items()}
+_OPTIONS_STR = "\n\n".join(
+    ["六妙門禪修法門："]
+    + [f"【{gate}】- {info['description'][:30]}... (適合{info['level']})"
+       for gate, info in SIX_GATES.items()]
+    + ["\n請輸入「禪修指導：數息」等命令來獲取特定引導。"]
+)
 
 def handle_meditation_command(user_id: str, openai_api_key: str, command: str = None, user_context: Dict = None) -> str:
     """處理禪修相關的用戶命令"""
@@ -1,10 +1,78 @@
+import base64
+import copy
+import difflib
+import functools
+import hashlib
+import math
 import os
-import requests
+import asyncio
+import aiohttp
+import pickle
+import re
 import feedparser
 import json
+import threading
+from cachetools import LRUCache, TTLCache, cached
 from datetime import datetime
 from typing import List, Dict, Optional, Union
+from urllib.parse import urlsplit
 from agent import get_agent
+from user_context import get_user_context, save_user_context
+
+# 可選的 lxml 快速解析：C 解析器比 feedparser 的純 Python 解析快一個數量級，
+# 未安裝或解析失敗時回退 feedparser
+try:
+    from lxml import etree as _lxml_etree
+except ImportError:
+    _lxml_etree = None
+
+# 常駐抓取事件循環：所有新聞抓取協程都跑在這個循環上，共享同一個
+# aiohttp 會話，讓 TCP/TLS 連接真正跨請求復用——若每次 asyncio.run
+# 新建循環，會話與連接池也得隨之新建，形同沒有池化
+_FETCH_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_FETCH_LOOP.run_forever,
+                 name="news-fetch-loop", daemon=True).start()
+
+_AIOHTTP_SESSION: Optional["aiohttp.ClientSession"] = None
+
+async def _get_aiohttp_session() -> "aiohttp.ClientSession":
+    """惰性創建綁定抓取循環的共享 aiohttp 會話"""
+    global _AIOHTTP_SESSION
+    if _AIOHTTP_SESSION is None or _AIOHTTP_SESSION.closed:
+        _AIOHTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16))
+    return _AIOHTTP_SESSION
+
+def _run_on_fetch_loop(coro):
+    """把協程提交到常駐抓取循環並同步等待結果"""
+    return asyncio.run_coroutine_threadsafe(coro, _FETCH_LOOP).result()
+
+# RSS 條件請求快取：url → (etag, last_modified, articles)。
+# 源未變時服務器回 304，省下整份 XML 的下載與解析；
+# 快取持久化到 data/ 下，跨進程與重啟復用
+_FEED_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'feed_cache.pkl')
+_FEED_CACHE_LOCK = threading.Lock()
+
+try:
+    with open(_FEED_CACHE_PATH, 'rb') as _f:
+        _FEED_CACHE = pickle.load(_f)
+except Exception:
+    _FEED_CACHE = {}
+
+def _save_feed_cache() -> None:
+    """持久化RSS條件請求快取（先寫臨時文件再原子替換）"""
+    try:
+        with _FEED_CACHE_LOCK:
+            tmp_path = _FEED_CACHE_PATH + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(_FEED_CACHE, f)
+            os.replace(tmp_path, _FEED_CACHE_PATH)
+    except Exception as e:
+        print(f"無法保存RSS快取: {e}")
+
+# HTML標籤正則：模塊級預編譯一次，每條新聞描述都要清洗；
+# [^>]* 不做惰性回溯，比 .*? 略快
+_HTML_TAG_RE = re.compile(r'<[^>]*>', re.DOTALL)
 
 # 只保留GNews API
 GNEWS_API_URL = "https://gnews.io/api/v4/top-headlines"
@@ -57,6 +125,34 @@ NEWS_CATEGORIES = {
     "taiwan": "台灣"
 }
 
+# 啟動時預熱連接：透過共享 aiohttp 會話對每個不重複的新聞主機
+# 發一次 HEAD，讓 DNS 解析與 TLS 握手在首個用戶請求前完成，
+# 熱連接留在正式抓取所用的同一個連接池裡
+async def _warm_connections() -> None:
+    hosts = set()
+    for feeds in TAIWAN_RSS_FEEDS.values():
+        for feed_info in feeds:
+            parts = urlsplit(feed_info["url"])
+            hosts.add(f"{parts.scheme}://{parts.netloc}")
+    parts = urlsplit(GNEWS_API_URL)
+    hosts.add(f"{parts.scheme}://{parts.netloc}")
+
+    session = await _get_aiohttp_session()
+
+    async def _head(host: str) -> None:
+        try:
+            async with session.head(
+                    host, timeout=aiohttp.ClientTimeout(total=5)):
+                pass
+        except Exception:
+            # 預熱失敗無妨，正式請求時再建連接
+            pass
+
+    await asyncio.gather(*[_head(host) for host in hosts])
+
+# 提交到常駐抓取循環後台執行，不阻塞模塊導入
+asyncio.run_coroutine_threadsafe(_warm_connections(), _FETCH_LOOP)
+
 # 新聞源圖標映射
 NEWS_SOURCE_ICONS = {
     "自由時報": "https://www.ltn.com.tw/assets/images/logo.png",
@@ -73,209 +169,543 @@ NEWS_CATEGORY_ICONS = {
     "taiwan": "https://cdn-icons-png.flaticon.com/512/164/164877.png"
 }
 
-def get_news_by_rss(category: str = None, count: int = 10) -> List[Dict]:
-    """使用台灣新聞源的RSS獲取最新新聞"""
-    articles = []
-    
-    # 確定要獲取的類別
-    feeds_to_fetch = []
+def _select_feeds(category: str = None) -> List[Dict]:
+    """確定要抓取的RSS源列表"""
     if category and category.lower() in TAIWAN_RSS_FEEDS:
-        feeds_to_fetch = TAIWAN_RSS_FEEDS[category.lower()]
-    else:
-        # 如果沒指定類別或類別不存在，從所有類別中各取一個源
-        for cat in TAIWAN_RSS_FEEDS:
-            if TAIWAN_RSS_FEEDS[cat]:
-                feeds_to_fetch.append(TAIWAN_RSS_FEEDS[cat][0])
-    
-    # 從選定的RSS源獲取新聞
-    for feed_info in feeds_to_fetch:
-        try:
-            feed = feedparser.parse(feed_info["url"])
-            source_name = feed_info["name"]
-            
-            for entry in feed.entries[:5]:  # 每個源取5條
-                # 檢查是否有必要欄位
-                if not hasattr(entry, 'title') or not hasattr(entry, 'link'):
-                    continue
-                
-                # 提取發布時間
-                published_at = ""
-                if hasattr(entry, 'published'):
-                    published_at = entry.published
-                elif hasattr(entry, 'pubDate'):
-                    published_at = entry.pubDate
-                
-                # 提取描述
-                description = ""
-                if hasattr(entry, 'description'):
-                    description = entry.description
-                elif hasattr(entry, 'summary'):
-                    description = entry.summary
-                
-                # 去除HTML標籤
-                import re
-                description = re.sub(r'<.*?>', '', description)
-                
-                # 嘗試獲取封面圖片
-                image_url = None
-                if hasattr(entry, 'media_content'):
-                    for media in entry.media_content:
-                        if 'url' in media:
-                            image_url = media['url']
-                            break
-                
-                # 添加到文章列表
-                articles.append({
-                    'title': entry.title,
-                    'url': entry.link,
-                    'description': description,
-                    'source': source_name,
-                    'domain': extract_domain(entry.link),
-                    'publishedAt': published_at,
-                    'image': image_url
-                })
-                
-                # 如果已經達到需要的數量，提前返回
-                if len(articles) >= count:
-                    return articles
-                
-        except Exception as e:
-            print(f"從RSS源獲取新聞失敗 ({feed_info['name']}): {e}")
-    
+        return TAIWAN_RSS_FEEDS[category.lower()]
+    # 如果沒指定類別或類別不存在，從所有類別中各取一個源
+    return [TAIWAN_RSS_FEEDS[cat][0] for cat in TAIWAN_RSS_FEEDS if TAIWAN_RSS_FEEDS[cat]]
+
+def _parse_feed_entries(feed, feed_info: Dict) -> List[Dict]:
+    """將解析好的feed轉為標準文章列表"""
+    articles = []
+    source_name = feed_info["name"]
+
+    for entry in feed.entries[:5]:  # 每個源取5條
+        # 檢查是否有必要欄位
+        if not hasattr(entry, 'title') or not hasattr(entry, 'link'):
+            continue
+
+        # 提取發布時間
+        published_at = ""
+        if hasattr(entry, 'published'):
+            published_at = entry.published
+        elif hasattr(entry, 'pubDate'):
+            published_at = entry.pubDate
+
+        # 提取描述
+        description = ""
+        if hasattr(entry, 'description'):
+            description = entry.description
+        elif hasattr(entry, 'summary'):
+            description = entry.summary
+
+        # 去除HTML標籤
+        description = _HTML_TAG_RE.sub('', description)
+
+        # 嘗試獲取封面圖片
+        image_url = None
+        if hasattr(entry, 'media_content'):
+            for media in entry.media_content:
+                if 'url' in media:
+                    image_url = media['url']
+                    break
+
+        # 添加到文章列表
+        articles.append({
+            'title': entry.title,
+            'url': entry.link,
+            'description': description,
+            'source': source_name,
+            'domain': extract_domain(entry.link),
+            'publishedAt': published_at,
+            'image': image_url
+        })
+
     return articles
 
-def get_news_by_gnews(category: str = None, country: str = 'tw', count: int = 10) -> List[Dict]:
-    """使用 GNews API 獲取最新新聞"""
+# RSS/Atom 解析用的命名空間前綴
+_ATOM_NS = '{http://www.w3.org/2005/Atom}'
+_MEDIA_NS = '{http://search.yahoo.com/mrss/}'
+
+def _parse_rss_fast(xml_bytes: bytes, feed_info: Dict) -> List[Dict]:
+    """用 lxml 直接抽取 title/link/description/pubDate/media:content，
+    只走一遍 C 解析器，不構建 feedparser 的完整物件模型"""
+    parser = _lxml_etree.XMLParser(huge_tree=False, recover=True)
+    root = _lxml_etree.fromstring(xml_bytes, parser)
+    if root is None:
+        return []
+
+    source_name = feed_info["name"]
+    articles = []
+
+    # RSS 的 item 與 Atom 的 entry 擇一
+    items = root.findall('.//item') or root.findall('.//' + _ATOM_NS + 'entry')
+    for item in items[:5]:  # 每個源取5條
+        # RSS 與 Atom 的標題/鏈接提取方式不同
+        title = item.findtext('title') or item.findtext(_ATOM_NS + 'title')
+        link = item.findtext('link')
+        if not link:
+            link_el = item.find(_ATOM_NS + 'link')
+            if link_el is not None:
+                link = link_el.get('href')
+        if not title or not link:
+            continue
+        title = title.strip()
+        link = link.strip()
+
+        description = (item.findtext('description')
+                       or item.findtext(_ATOM_NS + 'summary')
+                       or item.findtext(_ATOM_NS + 'content')
+                       or "")
+        description = _HTML_TAG_RE.sub('', description)
+
+        published_at = (item.findtext('pubDate')
+                        or item.findtext(_ATOM_NS + 'published')
+                        or item.findtext(_ATOM_NS + 'updated')
+                        or "")
+
+        image_url = None
+        media = item.find(_MEDIA_NS + 'content')
+        if media is not None:
+            image_url = media.get('url')
+
+        articles.append({
+            'title': title,
+            'url': link,
+            'description': description,
+            'source': source_name,
+            'domain': extract_domain(link),
+            'publishedAt': published_at,
+            'image': image_url
+        })
+
+    return articles
+
+def _parse_feed_bytes(data: bytes, feed_info: Dict) -> List[Dict]:
+    """解析下載好的feed字節：優先走 lxml 快速路徑，失敗或無結果時回退feedparser"""
+    if _lxml_etree is not None:
+        try:
+            articles = _parse_rss_fast(data, feed_info)
+            if articles:
+                return articles
+        except Exception:
+            pass
+    feed = feedparser.parse(data)
+    return _parse_feed_entries(feed, feed_info)
+
+async def _fetch_feed(session: "aiohttp.ClientSession", feed_info: Dict) -> List[Dict]:
+    """非同步抓取單一RSS源：先下載原始字節再解析，
+    網路等待全程不佔住事件循環。帶 ETag/Last-Modified 條件請求，
+    源未變時直接返回上次解析好的文章"""
+    url = feed_info["url"]
+    etag, last_modified, cached_articles = _FEED_CACHE.get(url, (None, None, None))
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    try:
+        async with session.get(
+                url, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            # 304：源自上次抓取後未更新，跳過下載與解析
+            if resp.status == 304 and cached_articles is not None:
+                return cached_articles
+            data = await resp.read()
+
+        articles = _parse_feed_bytes(data, feed_info)
+        _FEED_CACHE[url] = (
+            resp.headers.get('ETag'),
+            resp.headers.get('Last-Modified'),
+            articles
+        )
+        return articles
+    except Exception as e:
+        print(f"從RSS源獲取新聞失敗 ({feed_info['name']}): {e}")
+        return cached_articles or []
+
+async def get_news_by_rss_async(category: str = None, count: int = 10) -> List[Dict]:
+    """非同步並發抓取RSS新聞：各源的DNS/TLS/下載完全重疊，
+    總延遲約等於最慢的一個源，而非各源相加"""
+    feeds_to_fetch = _select_feeds(category)
+
+    session = await _get_aiohttp_session()
+    results = await asyncio.gather(
+        *[_fetch_feed(session, fi) for fi in feeds_to_fetch],
+        return_exceptions=True
+    )
+
+    # 整批抓完只持久化一次條件請求快取
+    _save_feed_cache()
+
+    articles = []
+    for result in results:
+        if isinstance(result, Exception):
+            continue
+        articles.extend(result)
+        if len(articles) >= count:
+            break
+
+    return articles[:count]
+
+async def get_news_by_gnews_async(category: str = None, country: str = 'tw',
+                                  count: int = 10) -> List[Dict]:
+    """非同步版 GNews 抓取，與RSS抓取併發執行"""
     try:
         params = {
-            'token': GNEWS_API_KEY,
+            'token': GNEWS_API_KEY or '',
             'max': count,
             'lang': 'zh-tw',
         }
-        
+
         # 根據分類調整請求參數
         if category:
             params['topic'] = category.lower()
-            
+
         # 決定國際或台灣新聞
         if country and country.lower() in ['tw', 'taiwan']:
             params['country'] = 'tw'
-            
-        response = requests.get(
-            GNEWS_API_URL,
-            params=params
-        )
-        
-        if response.status_code == 200:
-            articles = response.json().get('articles', [])
-            # 轉換為標準格式
-            return [{
-                'title': a.get('title', ''),
-                'url': a.get('url', ''),
-                'description': a.get('description', ''),
-                'source': a.get('source', {}).get('name', ''),
-                'publishedAt': a.get('publishedAt', '')
-            } for a in articles]
-        return []
+
+        session = await _get_aiohttp_session()
+        async with session.get(
+                GNEWS_API_URL, params=params,
+                timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            if resp.status != 200:
+                return []
+            payload = await resp.json()
+
+        # 轉換為標準格式
+        return [{
+            'title': a.get('title', ''),
+            'url': a.get('url', ''),
+            'description': a.get('description', ''),
+            'source': a.get('source', {}).get('name', ''),
+            'publishedAt': a.get('publishedAt', '')
+        } for a in payload.get('articles', [])]
     except Exception as e:
         print(f"獲取新聞失敗 (GNews): {e}")
         return []
 
+class BloomFilter:
+    """純 Python 布隆過濾器：O(1) 成員判斷、常數內存，
+    可序列化成 base64 字串存入用戶上下文的 JSON"""
+
+    def __init__(self, capacity: int = 5000, error_rate: float = 0.001):
+        # 經典公式：m = -n·ln(p)/ln(2)²，k = (m/n)·ln(2)
+        num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(1, round((self.num_bits / capacity) * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _bit_positions(self, item: str):
+        # 雙重哈希：用 sha1 摘要的兩半模擬 k 個獨立哈希函數
+        digest = hashlib.sha1(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item: str) -> None:
+        for pos in self._bit_positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._bit_positions(item))
+
+    def to_base64(self) -> str:
+        header = f"{self.num_hashes}:{self.num_bits}:"
+        return header + base64.b64encode(bytes(self.bits)).decode('ascii')
+
+    @classmethod
+    def from_base64(cls, raw: str) -> "BloomFilter":
+        num_hashes, num_bits, payload = raw.split(':', 2)
+        bloom = cls.__new__(cls)
+        bloom.num_hashes = int(num_hashes)
+        bloom.num_bits = int(num_bits)
+        bloom.bits = bytearray(base64.b64decode(payload))
+        return bloom
+
+# 近似去重的參數：字符 5-gram，重合率超過 70% 視為同稿
+_SHINGLE_SIZE = 5
+_NEAR_DUP_THRESHOLD = 0.7
+
+def _shingles(text: str, size: int = _SHINGLE_SIZE) -> List[str]:
+    """把文本切成重疊的字符 n-gram"""
+    if len(text) < size:
+        return [text] if text else []
+    return [text[i:i + size] for i in range(len(text) - size + 1)]
+
 def filter_news_articles(articles: List[Dict]) -> List[Dict]:
     """過濾和清理新聞文章"""
     filtered_articles = []
-    
+    seen_titles = set()
+    seen_urls = set()
+    # 各家媒體常改標題轉載同一篇通訊社稿：把 標題+摘要 的字符 5-gram
+    # 塞進布隆過濾器，後續文章的 n-gram 重合率過高即視為近似重複
+    shingle_bloom = BloomFilter(capacity=20000, error_rate=0.01)
+
     for article in articles:
+        title = article.get('title')
+        url = article.get('url')
+
         # 過濾無效的文章
-        if not article.get('title') or not article.get('url'):
+        if not title or not url:
             continue
-            
+
         # 過濾重複的標題
-        if any(a.get('title') == article.get('title') for a in filtered_articles):
+        if title in seen_titles:
+            continue
+
+        # 以去除查詢參數的URL去重：同一篇文章常帶不同的追蹤參數出現
+        normalized_url = url.split('?', 1)[0]
+        if normalized_url in seen_urls:
             continue
-            
-        # 確保來源可靠
-        source_name = article.get('source', {}).get('name', '')
-        source_domain = extract_domain(article.get('url', ''))
-        
+
+        # 近似去重：n-gram 大量命中布隆過濾器說明內容與已收文章雷同
+        shingles = _shingles(title + article.get('description', '')[:200])
+        if shingles:
+            seen_count = sum(1 for s in shingles if s in shingle_bloom)
+            if seen_count / len(shingles) > _NEAR_DUP_THRESHOLD:
+                continue
+            for s in shingles:
+                shingle_bloom.add(s)
+
+        seen_titles.add(title)
+        seen_urls.add(normalized_url)
+
+        # 確保來源可靠（GNews 原始格式的 source 是 dict，標準格式是字串）
+        source = article.get('source', '')
+        source_name = source.get('name', '') if isinstance(source, dict) else source
+        source_domain = extract_domain(url)
+
         filtered_articles.append({
-            'title': article.get('title', ''),
-            'url': article.get('url', ''),
+            'title': title,
+            'url': url,
             'description': article.get('description', ''),
             'source': source_name,
             'domain': source_domain,
             'publishedAt': article.get('publishedAt', '')
         })
-    
+
     return filtered_articles
 
+@functools.lru_cache(maxsize=2048)
 def extract_domain(url: str) -> str:
-    """從 URL 提取域名"""
+    """從 URL 提取域名（每篇文章都會調用，同一來源的URL高度重複）"""
     try:
         from urllib.parse import urlparse
         return urlparse(url).netloc
     except:
         return ""
 
-def get_news_options(category: str = None, country: str = None) -> List[Dict]:
-    """獲取新聞選項供用戶選擇"""
-    # 首先嘗試從RSS源獲取新聞
-    articles = get_news_by_rss(category)
-    
-    # 如果RSS源獲取失敗或數量不足，嘗試 GNews
-    if len(articles) < 3:
-        gnews_articles = get_news_by_gnews(category, country)
-        # 合併並去重
-        seen_titles = {a.get('title') for a in articles}
-        for article in gnews_articles:
-            if article.get('title') not in seen_titles:
-                articles.append(article)
-                seen_titles.add(article.get('title'))
-    
+async def get_news_options_async(category: str = None, country: str = None) -> List[Dict]:
+    """非同步獲取新聞選項：RSS與GNews併發抓取，總延遲取兩者較慢者"""
+    rss_articles, gnews_articles = await asyncio.gather(
+        get_news_by_rss_async(category),
+        get_news_by_gnews_async(category, country)
+    )
+
+    # RSS優先，GNews補足並按標題去重
+    articles = list(rss_articles)
+    seen_titles = {a.get('title') for a in articles}
+    for article in gnews_articles:
+        if article.get('title') not in seen_titles:
+            articles.append(article)
+            seen_titles.add(article.get('title'))
+
     # 僅返回前10項作為選項
     return articles[:10]
 
+# 新聞選項 TTL 快取：handle_news_command 的部分分支會重複調用，
+# 且多個快速回覆按鈕映射到同一類別——5分鐘窗口內的重複請求直接命中，
+# 不再觸發整輪 RSS/GNews 抓取
+_NEWS_OPTIONS_CACHE = TTLCache(maxsize=32, ttl=300)
+_NEWS_OPTIONS_LOCK = threading.Lock()
+
+@cached(_NEWS_OPTIONS_CACHE, lock=_NEWS_OPTIONS_LOCK,
+        key=lambda category=None, country=None: (category or "", country or ""))
+def get_news_options(category: str = None, country: str = None) -> List[Dict]:
+    """獲取新聞選項供用戶選擇（同步包裝，帶5分鐘TTL快取）。
+
+    協程提交到常駐抓取循環執行，復用共享 aiohttp 會話的連接池。"""
+    return _run_on_fetch_loop(get_news_options_async(category, country))
+
+# 省思提示詞模板：模塊級常量，每次調用只做一次 .format
+_REFLECTION_TEMPLATE = ("請基於佛教智慧，特別是因果、無常、緣起等觀點，分析以下新聞：\n\n"
+                        "標題：{title}\n"
+                        "內容摘要：{description}\n"
+                        "來源：{source}\n"
+                        "{user_background}\n\n"
+                        "請提供：\n"
+                        "1. 從佛法角度看這則新聞反映的現象\n"
+                        "2. 這個事件如何體現佛教中的因果、無常或緣起法則\n"
+                        "3. 如何將這個新聞中的啟示應用到日常修行中\n"
+                        "4. 一個相關的佛經教導或故事（如有）")
+
+# 同一篇文章的省思內容不變：按 (標題, 來源) 記憶化，
+# 重複點擊同一則新聞的省思按鈕不再重新走一次 LLM
+_REFLECTION_CACHE = LRUCache(maxsize=256)
+_REFLECTION_LOCK = threading.Lock()
+
 def generate_buddhist_reflection(news_article: Dict, openai_api_key: str, user_context: Dict = None) -> str:
     """根據佛教觀點生成對新聞的分析和反思"""
     if not news_article or not openai_api_key:
         return "無法生成分析，缺少新聞資料或API密鑰。"
-    
+
     title = news_article.get('title', '')
     url = news_article.get('url', '')
     description = news_article.get('description', '')
     source = news_article.get('source', '')
-    
+
+    # 標題和摘要都為空時沒有可省思的內容，直接短路，省一次 LLM 往返
+    if not title and not description:
+        return "資訊不足，無法生成省思。"
+
     # 獲取用戶背景信息
     user_background = ""
     if user_context and 'background' in user_context:
         user_background = f"\n考慮以下用戶背景: {user_context['background']}"
-    
-    # 使用 agent 生成佛教反思
-    agent = get_agent(openai_api_key, 'news_reflection')
-    
-    prompt = (f"請基於佛教智慧，特別是因果、無常、緣起等觀點，分析以下新聞：\n\n"
-              f"標題：{title}\n"
-              f"內容摘要：{description}\n"
-              f"來源：{source}\n"
-              f"{user_background}\n\n"
-              f"請提供：\n"
-              f"1. 從佛法角度看這則新聞反映的現象\n"
-              f"2. 這個事件如何體現佛教中的因果、無常或緣起法則\n"
-              f"3. 如何將這個新聞中的啟示應用到日常修行中\n"
-              f"4. 一個相關的佛經教導或故事（如有）")
-    
+
+    # 帶用戶背景的省思是個性化內容，不讀寫共享快取，
+    # 避免把一個用戶的背景洩漏給點同一篇文章的其他用戶
+    cacheable = not user_background
+    cache_key = (title, source)
+    if cacheable:
+        with _REFLECTION_LOCK:
+            cached_reflection = _REFLECTION_CACHE.get(cache_key)
+        if cached_reflection is not None:
+            return cached_reflection
+
+    # 使用 agent 生成佛教反思（高流量路徑，走快速模型）
+    agent = get_agent(openai_api_key, 'news_reflection', fast=True)
+
+    prompt = _REFLECTION_TEMPLATE.format(title=title, description=description,
+                                         source=source, user_background=user_background)
+
     try:
-        reflection = agent.run(prompt)
+        reflection = agent(prompt)
     except Exception as e:
-        reflection = f"無法生成反思：{e}"
-    
+        # 失敗結果不進緩存，下次點擊可重試
+        return (f"📰 **{title}**\n"
+                f"🔗 {url}\n\n"
+                f"🙏 **佛教省思**:\n無法生成反思：{e}")
+
     # 格式化輸出
     formatted_reflection = (f"📰 **{title}**\n"
                            f"🔗 {url}\n\n"
                            f"🙏 **佛教省思**:\n{reflection}")
-    
+
+    if cacheable:
+        with _REFLECTION_LOCK:
+            _REFLECTION_CACHE[cache_key] = formatted_reflection
+
     return formatted_reflection
 
+async def generate_buddhist_reflections_batch(articles: List[Dict], openai_api_key: str,
+                                              user_context: Dict = None,
+                                              max_concurrency: int = 10) -> List[str]:
+    """並發為多則新聞生成佛教省思。
+
+    各則省思彼此獨立，透過 asyncio.gather 讓 N 次 LLM 呼叫在網路層重疊，
+    總延遲約等於最慢一則而非全部相加；max_concurrency 限制同時在途的請求數。
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _one(article: Dict) -> str:
+        async with semaphore:
+            return await asyncio.to_thread(
+                generate_buddhist_reflection, article, openai_api_key, user_context
+            )
+
+    return list(await asyncio.gather(*[_one(article) for article in articles]))
+
+# 新聞氣泡的固定結構：模塊級模板，每則新聞 deepcopy 後只改動可變字段，
+# 避免在熱路徑上逐則重建 ~40 行的嵌套字典字面量
+_PLACEHOLDER_IMAGE = "https://cdn-icons-png.flaticon.com/512/2965/2965879.png"
+_BUBBLE_TEMPLATE = {
+    "type": "bubble",
+    "hero": {
+        "type": "image",
+        "url": _PLACEHOLDER_IMAGE,
+        "size": "full",
+        "aspectRatio": "20:13",
+        "aspectMode": "cover"
+    },
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "",
+                "weight": "bold",
+                "size": "md",
+                "wrap": True,
+                "maxLines": 2
+            },
+            {
+                "type": "box",
+                "layout": "baseline",
+                "contents": [
+                    {
+                        "type": "icon",
+                        "url": _PLACEHOLDER_IMAGE,
+                        "size": "xs"
+                    },
+                    {
+                        "type": "text",
+                        "text": "",
+                        "size": "xs",
+                        "color": "#8c8c8c",
+                        "margin": "md"
+                    }
+                ],
+                "margin": "md"
+            },
+            {
+                "type": "text",
+                "text": "",
+                "size": "xs",
+                "color": "#8c8c8c",
+                "wrap": True,
+                "margin": "md",
+                "maxLines": 3
+            }
+        ]
+    },
+    "footer": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "button",
+                "action": {
+                    "type": "uri",
+                    "label": "查看新聞",
+                    "uri": ""
+                },
+                "style": "primary",
+                "height": "sm"
+            },
+            {
+                "type": "button",
+                "action": {
+                    "type": "message",
+                    "label": "佛教反思",
+                    "text": ""
+                },
+                "style": "secondary",
+                "height": "sm",
+                "margin": "sm"
+            }
+        ]
+    }
+}
+
 def create_news_flex_message(article: Dict) -> Dict:
     """為單個新聞創建Flex消息"""
     title = article.get('title', '')
@@ -283,95 +713,26 @@ def create_news_flex_message(article: Dict) -> Dict:
     description = article.get('description', '')
     source = article.get('source', '')
     image = article.get('image')
-    
+
     # 獲取新聞源圖標
-    source_icon = NEWS_SOURCE_ICONS.get(source, "https://cdn-icons-png.flaticon.com/512/2965/2965879.png")
-    
+    source_icon = NEWS_SOURCE_ICONS.get(source, _PLACEHOLDER_IMAGE)
+
     # 處理描述，限制長度
     if description and len(description) > 100:
         description = description[:97] + "..."
-    
-    # 創建Flex消息
-    flex_message = {
-        "type": "bubble",
-        "hero": {
-            "type": "image",
-            "url": image if image else "https://cdn-icons-png.flaticon.com/512/2965/2965879.png",
-            "size": "full",
-            "aspectRatio": "20:13",
-            "aspectMode": "cover"
-        },
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": title,
-                    "weight": "bold",
-                    "size": "md",
-                    "wrap": True,
-                    "maxLines": 2
-                },
-                {
-                    "type": "box",
-                    "layout": "baseline",
-                    "contents": [
-                        {
-                            "type": "icon",
-                            "url": source_icon,
-                            "size": "xs"
-                        },
-                        {
-                            "type": "text",
-                            "text": source,
-                            "size": "xs",
-                            "color": "#8c8c8c",
-                            "margin": "md"
-                        }
-                    ],
-                    "margin": "md"
-                },
-                {
-                    "type": "text",
-                    "text": description if description else "點擊查看詳情",
-                    "size": "xs",
-                    "color": "#8c8c8c",
-                    "wrap": True,
-                    "margin": "md",
-                    "maxLines": 3
-                }
-            ]
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "button",
-                    "action": {
-                        "type": "uri",
-                        "label": "查看新聞",
-                        "uri": url
-                    },
-                    "style": "primary",
-                    "height": "sm"
-                },
-                {
-                    "type": "button",
-                    "action": {
-                        "type": "message",
-                        "label": "佛教反思",
-                        "text": f"請提供新聞佛教反思：{title}"
-                    },
-                    "style": "secondary",
-                    "height": "sm",
-                    "margin": "sm"
-                }
-            ]
-        }
-    }
-    
+
+    # 從模板複製固定結構，只填入該則新聞的可變字段
+    flex_message = copy.deepcopy(_BUBBLE_TEMPLATE)
+    flex_message["hero"]["url"] = image if image else _PLACEHOLDER_IMAGE
+    body_contents = flex_message["body"]["contents"]
+    body_contents[0]["text"] = title
+    body_contents[1]["contents"][0]["url"] = source_icon
+    body_contents[1]["contents"][1]["text"] = source
+    body_contents[2]["text"] = description if description else "點擊查看詳情"
+    footer_contents = flex_message["footer"]["contents"]
+    footer_contents[0]["action"]["uri"] = url
+    footer_contents[1]["action"]["text"] = f"請提供新聞佛教反思：{title}"
+
     return flex_message
 
 def create_news_carousel(articles: List[Dict]) -> Dict:
@@ -394,58 +755,117 @@ def create_news_carousel(articles: List[Dict]) -> Dict:
     return carousel
 
 def format_news_selection_flex(articles: List[Dict]) -> Dict:
-    """使用Flex消息格式化新聞選項供用戶選擇"""
+    """使用Flex消息格式化新聞選項供用戶選擇。
+
+    返回類型化載荷：{"type": "text", ...} 或 {"type": "flex", "contents": ...}，
+    發送端按 type 直接分發，不再對字串做JSON嗅探與來回序列化。
+    """
     if not articles:
         return {
             "type": "text",
             "text": "抱歉，目前沒有找到相關新聞。"
         }
-    
-    return create_news_carousel(articles)
+
+    return {
+        "type": "flex",
+        "altText": "今日新聞選項",
+        "contents": create_news_carousel(articles)
+    }
+
+# 標題→文章索引：與 get_news_options 的 TTL 緩存並存，
+# 以文章列表的對象身份判斷是否還是同一批結果，列表刷新時索引同步重建
+_TITLE_INDEX_CACHE = LRUCache(maxsize=32)
+_TITLE_INDEX_LOCK = threading.Lock()
+
+def _title_to_article(articles: List[Dict], category: str = None, country: str = None) -> Dict[str, Dict]:
+    """返回該批文章的標題索引，同一批列表只建一次"""
+    key = (category or "", country or "")
+    with _TITLE_INDEX_LOCK:
+        entry = _TITLE_INDEX_CACHE.get(key)
+        if entry is not None and entry[0] is articles:
+            return entry[1]
+        index = {a['title']: a for a in articles if a.get('title')}
+        _TITLE_INDEX_CACHE[key] = (articles, index)
+        return index
+
+def _filter_seen_articles(articles: List[Dict], user_context: Dict, user_id: str) -> List[Dict]:
+    """用存在用戶上下文裡的布隆過濾器剔除已展示過的新聞。
+
+    過濾後不足 3 則時退回完整列表（寧可重複也不給近乎空的轉盤）；
+    本次展示的標題加入過濾器後序列化回上下文並保存。"""
+    raw = user_context.get("seen_news_bloom")
+    try:
+        bloom = BloomFilter.from_base64(raw) if raw else BloomFilter()
+    except Exception:
+        bloom = BloomFilter()
+
+    unseen = [a for a in articles if a.get('title') and a['title'] not in bloom]
+    if len(unseen) < 3:
+        unseen = articles
+
+    # 只把實際會進轉盤的前10則標記為已見
+    for article in unseen[:10]:
+        title = article.get('title')
+        if title:
+            bloom.add(title)
+
+    user_context["seen_news_bloom"] = bloom.to_base64()
+    save_user_context(user_id)
+    return unseen
+
+# 命令中的類別/地區關鍵詞：合成單個交替正則，一次掃描全部找齊
+_CMD_KEYWORD_RE = re.compile(r'政治|經濟|文化|國際|台灣')
 
 def handle_news_command(user_id: str, openai_api_key: str, command: str = None, selection: str = None, user_context: Dict = None) -> Union[str, Dict]:
     """處理新聞相關的用戶命令，返回文字或Flex消息"""
-    # 解析命令以獲取類別和地區
+    # 解析命令以獲取類別和地區：單次正則掃描代替五次子串掃描
     category = None
     country = None
-    
+
     if command:
-        if "政治" in command:
+        found = set(_CMD_KEYWORD_RE.findall(command))
+        if "政治" in found:
             category = "politics"
-        elif "經濟" in command:
+        elif "經濟" in found:
             category = "economics"
-        elif "文化" in command:
+        elif "文化" in found:
             category = "culture"
-            
-        if "國際" in command:
+
+        if "國際" in found:
             country = "international"
-        elif "台灣" in command:
+        elif "台灣" in found:
             country = "taiwan"
     
+    # 同一組 (category, country) 的新聞選項只取一次，三個分支共用
+    articles = get_news_options(category, country)
+
     # 如果用戶提供了選擇
     if selection and selection.isdigit():
         selection_idx = int(selection) - 1
-        
-        # 獲取新聞選項
-        articles = get_news_options(category, country)
-        
+
         if 0 <= selection_idx < len(articles):
             selected_article = articles[selection_idx]
             return generate_buddhist_reflection(selected_article, openai_api_key, user_context)
         else:
             return "選擇無效，請提供有效的選項編號。"
-    
-    # 特殊處理：如果命令中包含特定新聞標題，找到這個新聞並生成反思
+
+    # 特殊處理：如果命令中包含特定新聞標題，用標題索引 O(1) 定位
     if command and command.startswith("請提供新聞佛教反思："):
         title = command.replace("請提供新聞佛教反思：", "").strip()
-        articles = get_news_options(category, country)
-        for article in articles:
-            if article.get('title') == title:
-                return generate_buddhist_reflection(article, openai_api_key, user_context)
+        title_index = _title_to_article(articles, category, country)
+        article = title_index.get(title)
+        if article is None:
+            # 標題被 LINE 截斷或輕微改動時做一次模糊匹配（列表很小，代價可忽略）
+            close = difflib.get_close_matches(title, title_index.keys(), n=1, cutoff=0.8)
+            if close:
+                article = title_index[close[0]]
+        if article is not None:
+            return generate_buddhist_reflection(article, openai_api_key, user_context)
         return "找不到指定的新聞，請重新選擇。"
-    
-    # 如果用戶沒有提供選擇，返回新聞選項
-    articles = get_news_options(category, country)
-    
-    # 返回Flex消息
+
+    # 如果用戶沒有提供選擇，返回新聞選項的Flex消息；
+    # 先剔除該用戶已看過的新聞（調用方未傳上下文時自行加載）
+    if user_context is None:
+        user_context = get_user_context(user_id)
+    articles = _filter_seen_articles(articles, user_context, user_id)
     return format_news_selection_flex(articles) 
\ No newline at end of file
@@ -19,25 +19,29 @@ load_dotenv()
 def run_server():
     # 獲取環境變量
     port = int(os.getenv('PORT', 8080))
-    workers = int(os.getenv('WORKERS', multiprocessing.cpu_count() * 2 + 1))  # Gunicorn推薦的工作進程數
-    
+    # ASGI worker 內部靠事件循環並發處理 I/O，單 worker 即可同時掛起
+    # 大量出站請求，進程數取 CPU 核數即可，無需 sync worker 時代的 2n+1
+    workers = int(os.getenv('WORKERS', multiprocessing.cpu_count()))
+
     logger.info(f"啟動生產服務器，端口: {port}，工作進程數: {workers}")
-    
+
     # 檢查是否已安裝Gunicorn
     try:
         import gunicorn
     except ImportError:
         logger.error("未安裝Gunicorn，請運行: pip install gunicorn")
         sys.exit(1)
-    
+
     # 構建Gunicorn命令
     cmd = [
         "gunicorn",
         "--bind", f"0.0.0.0:{port}",
         "--workers", str(workers),
-        "--worker-class", "sync",  # 同步工作進程
+        "--worker-class", "uvicorn.workers.UvicornWorker",  # ASGI工作進程（Quart應用）
         "--timeout", "120",  # 請求超時時間
-        "--reload",  # 開發環境中使用，生產環境可以移除
+        # 不使用 --preload：日誌 QueueListener 線程與 SQLite 連接等模塊級
+        # 狀態無法跨 fork 存活；CBETA 索引本就逐 worker 惰性構建，
+        # mmap 的 .npy 快取由操作系統頁快取天然共享
         "--access-logfile", "-",  # 將訪問日誌輸出到標準輸出
         "--error-logfile", "-",  # 將錯誤日誌輸出到標準輸出
         "app:app"  # 指定應用模塊
@@ -1,7 +1,8 @@
 import os
 import random
+import re
 from linebot.models import QuickReply, QuickReplyButton, MessageAction, URIAction
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 
 # 導入新的模塊
 from news_module import handle_news_command
@@ -28,9 +29,9 @@ def generate_related_question(topic: str, openai_api_key: str) -> Optional[str]:
     
     try:
         from agent import get_agent
-        agent = get_agent(openai_api_key, 'quick_reply_generator')
+        agent = get_agent(openai_api_key, 'quick_reply_generator', fast=True)
         prompt = f"根據用戶提問「{topic}」，生成一個相關的follow-up問題，簡短20字以內，不要說明，直接給出問題"
-        related_question = agent.run(prompt)
+        related_question = agent(prompt)
         
         if len(related_question) <= 20:
             return related_question
@@ -76,33 +77,35 @@ def generate_quick_replies(user_id: str, recent_message: str = "", user_last_top
     
     return QuickReply(items=quick_replies[:4])  # LINE限制最多13個按鈕，但我們只使用4個避免介面擁擠
 
+# 命令碼→處理函數的分發表：取代逐項 if/elif 比對，新增命令只需加一行
+_DISPATCH: Dict[str, Callable[[str, str], Union[str, Dict]]] = {
+    "NEWS_OPTIONS": lambda uid, key: handle_news_command(uid, key),
+    "MEDITATION_GUIDE": lambda uid, key: handle_meditation_command(uid, key),
+    "MEDITATION_OPTIONS": lambda uid, key: handle_meditation_command(uid, key, "列表"),
+    "NEWS_TW_POLITICS": lambda uid, key: handle_news_command(uid, key, "台灣政治新聞"),
+    "NEWS_INTL_ECONOMICS": lambda uid, key: handle_news_command(uid, key, "國際經濟新聞"),
+    "NEWS_CULTURE": lambda uid, key: handle_news_command(uid, key, "文化新聞"),
+}
+
+# 判斷命令類型的預編譯正則：一次掃描取代 startswith+多個子串檢查
+_NEWS_CMD_RE = re.compile(r'^NEWS_|新聞|時事')
+_MEDITATION_CMD_RE = re.compile(r'^MEDITATION_|禪修')
+
 def handle_quick_reply_request(command: str, user_id: str, openai_api_key: str) -> Union[str, Dict]:
     """處理快速回覆請求，返回文本或Flex消息"""
     # 檢查是否為新聞相關命令
-    if command.startswith("NEWS_") or "新聞" in command or "時事" in command:
+    if _NEWS_CMD_RE.search(command):
         return handle_news_command(user_id, openai_api_key, command)
-    
+
     # 檢查是否為禪修相關命令
-    elif command.startswith("MEDITATION_") or "禪修" in command:
+    elif _MEDITATION_CMD_RE.search(command):
         return handle_meditation_command(user_id, openai_api_key, command)
-    
-    # 根據命令轉發到具體處理函數
-    if command in QUICK_REPLY_COMMANDS:
-        command_code = QUICK_REPLY_COMMANDS[command]
-        
-        if command_code == "NEWS_OPTIONS":
-            return handle_news_command(user_id, openai_api_key)
-        elif command_code == "MEDITATION_GUIDE":
-            return handle_meditation_command(user_id, openai_api_key)
-        elif command_code == "MEDITATION_OPTIONS":
-            return handle_meditation_command(user_id, openai_api_key, "列表")
-        elif command_code == "NEWS_TW_POLITICS":
-            return handle_news_command(user_id, openai_api_key, "台灣政治新聞")
-        elif command_code == "NEWS_INTL_ECONOMICS":
-            return handle_news_command(user_id, openai_api_key, "國際經濟新聞")
-        elif command_code == "NEWS_CULTURE":
-            return handle_news_command(user_id, openai_api_key, "文化新聞")
-    
+
+    # 根據命令碼查分發表轉發到具體處理函數
+    handler = _DISPATCH.get(QUICK_REPLY_COMMANDS.get(command))
+    if handler is not None:
+        return handler(user_id, openai_api_key)
+
     return "未識別的命令。請嘗試其他選項。"
 
 # 擴展功能可以在這裡添加新的功能塊
@@ -1,8 +1,18 @@
+import atexit
 import os
 import json
+import re
+import sqlite3
+import threading
 import time
 from typing import Dict, List, Optional, Any
-from collections import defaultdict
+from collections import defaultdict, deque
+
+# 可選的 orjson：編解碼比標準庫 json 快數倍，未安裝時回退標準庫
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # 用戶上下文數據結構
 USER_CONTEXT_TEMPLATE = {
@@ -22,12 +32,80 @@ USER_CONTEXT_TEMPLATE = {
 # 內存中的用戶上下文緩存
 user_contexts = {}
 
-# 用戶上下文持久化路徑
+# 寫回緩衝：內部修改只標記髒位，每個公開入口函數結束時才寫一次盤，
+# 避免單條消息觸發多次完整的 json.dump
+_dirty_users = set()
+_dirty_lock = threading.Lock()
+
+# 可選的 Redis 聊天歷史後端：設置 REDIS_URL 後，聊天歷史存入 Redis，
+# 跨 worker 共享、重啟不丟失；未設置時沿用本地 JSON 上下文
+_redis_client = None
+try:
+    if os.getenv("REDIS_URL"):
+        import redis
+        _redis_client = redis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
+        _redis_client.ping()
+except Exception as e:
+    print(f"無法連接 Redis，聊天歷史改用本地文件: {e}")
+    _redis_client = None
+
+# 聊天歷史保留條數與 Redis 鍵的存活時間（秒）
+MAX_CHAT_HISTORY = 5
+CHAT_HISTORY_TTL = 86400
+
+def _chat_history_key(user_id: str) -> str:
+    return f"bodhi:chat_history:{user_id}"
+
+# 佛教相關關鍵詞
+BUDDHIST_KEYWORDS = [
+    "佛陀", "菩薩", "阿羅漢", "四聖諦", "八正道", "中道", "禪修", "冥想",
+    "六妙門", "數息", "隨息", "止", "觀", "還", "淨", "無常", "無我",
+    "空性", "涅槃", "慈悲", "般若", "菩提", "輪迴", "因果", "緣起"
+]
+
+# 預編譯成單個交替正則，一次掃描即可找出所有關鍵詞
+_KEYWORD_RE = re.compile('|'.join(map(re.escape, BUDDHIST_KEYWORDS)))
+
+# 舊版的逐用戶 JSON 文件目錄：僅用於惰性遷移讀取，新寫入一律進 SQLite
 USER_CONTEXT_DIR = os.path.join(os.path.dirname(__file__), 'data', 'user_contexts')
 
 # 確保目錄存在
 os.makedirs(USER_CONTEXT_DIR, exist_ok=True)
 
+# 用戶上下文統一存到單個 SQLite 文件：免去每用戶一個 JSON 文件的
+# open/read/close 與元數據系統調用；WAL 模式下讀寫互不阻塞
+_DB_PATH = os.path.join(os.path.dirname(__file__), 'data', 'user_contexts.db')
+_db_lock = threading.Lock()
+_db = sqlite3.connect(_DB_PATH, check_same_thread=False)
+_db.execute("PRAGMA journal_mode=WAL")
+_db.execute(
+    "CREATE TABLE IF NOT EXISTS user_contexts ("
+    "user_id TEXT PRIMARY KEY, context TEXT NOT NULL)"
+)
+_db.commit()
+
+# 有界列表的上限：deque(maxlen=N) 在追加時以 O(1) 截斷，免去每次切片複製
+MAX_QUESTIONS = 20
+MAX_MENTIONS = 50
+
+def _dumps_context(context: Dict) -> str:
+    """序列化上下文；default=list 把 deque 序列化成普通 JSON 數組"""
+    if orjson is not None:
+        return orjson.dumps(context, default=list).decode('utf-8')
+    return json.dumps(context, ensure_ascii=False, default=list)
+
+def _loads_context(raw: str) -> Dict:
+    """反序列化上下文，優先走 orjson"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def _wrap_bounded_lists(context: Dict) -> Dict:
+    """把需要截斷的列表包成帶 maxlen 的 deque（加載或新建上下文時調用一次）"""
+    context["questions"] = deque(context.get("questions", []), maxlen=MAX_QUESTIONS)
+    context["mentions"] = deque(context.get("mentions", []), maxlen=MAX_MENTIONS)
+    return context
+
 def get_user_context(user_id: str) -> Dict:
     """獲取用戶上下文，如果不存在則創建新的"""
     global user_contexts
@@ -35,18 +113,32 @@ def get_user_context(user_id: str) -> Dict:
     # 檢查內存緩存
     if user_id in user_contexts:
         return user_contexts[user_id]
-    
-    # 嘗試從文件加載
+
+    # 嘗試從 SQLite 加載
+    try:
+        with _db_lock:
+            row = _db.execute(
+                "SELECT context FROM user_contexts WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is not None:
+            context = _wrap_bounded_lists(_loads_context(row[0]))
+            user_contexts[user_id] = context
+            return context
+    except Exception as e:
+        print(f"加載用戶上下文失敗: {e}")
+
+    # 惰性遷移：SQLite 沒有時回讀舊版的逐用戶 JSON 文件，下次保存即入庫
     context_path = os.path.join(USER_CONTEXT_DIR, f"{user_id}.json")
     if os.path.exists(context_path):
         try:
             with open(context_path, 'r', encoding='utf-8') as f:
-                context = json.load(f)
+                context = _wrap_bounded_lists(_loads_context(f.read()))
                 user_contexts[user_id] = context
+                save_user_context(user_id)
                 return context
         except Exception as e:
             print(f"加載用戶上下文失敗: {e}")
-    
+
     # 創建新的上下文
     now = int(time.time())
     new_context = USER_CONTEXT_TEMPLATE.copy()
@@ -56,24 +148,51 @@ def get_user_context(user_id: str) -> Dict:
         "last_updated": now
     })
     
-    user_contexts[user_id] = new_context
+    user_contexts[user_id] = _wrap_bounded_lists(new_context)
     save_user_context(user_id)
     return new_context
 
 def save_user_context(user_id: str) -> bool:
-    """將用戶上下文保存到文件"""
+    """將用戶上下文保存到 SQLite（單條 UPSERT，事務保證原子性）"""
     if user_id not in user_contexts:
         return False
-    
-    context_path = os.path.join(USER_CONTEXT_DIR, f"{user_id}.json")
+
     try:
-        with open(context_path, 'w', encoding='utf-8') as f:
-            json.dump(user_contexts[user_id], f, ensure_ascii=False, indent=2)
+        blob = _dumps_context(user_contexts[user_id])
+        with _db_lock:
+            _db.execute(
+                "INSERT OR REPLACE INTO user_contexts (user_id, context) VALUES (?, ?)",
+                (user_id, blob)
+            )
+            _db.commit()
         return True
     except Exception as e:
         print(f"保存用戶上下文失敗: {e}")
         return False
 
+def _mark_dirty(user_id: str) -> None:
+    """標記上下文已修改，延後到入口函數結束時統一寫盤"""
+    with _dirty_lock:
+        _dirty_users.add(user_id)
+
+def flush_user_context(user_id: str = None) -> None:
+    """寫出髒的用戶上下文；user_id 為 None 時寫出全部（供 atexit 使用）"""
+    with _dirty_lock:
+        if user_id is None:
+            to_flush = list(_dirty_users)
+            _dirty_users.clear()
+        elif user_id in _dirty_users:
+            _dirty_users.discard(user_id)
+            to_flush = [user_id]
+        else:
+            to_flush = []
+
+    for uid in to_flush:
+        save_user_context(uid)
+
+# 進程退出前把殘留的髒上下文寫盤
+atexit.register(flush_user_context)
+
 def update_user_context(user_id: str, updates: Dict) -> Dict:
     """更新用戶上下文"""
     context = get_user_context(user_id)
@@ -85,108 +204,121 @@ def update_user_context(user_id: str, updates: Dict) -> Dict:
     
     # 更新時間戳
     context["last_updated"] = int(time.time())
-    
+
     # 增加互動計數
     context["interactions_count"] += 1
-    
+
     # 保存更新
-    save_user_context(user_id)
-    
+    _mark_dirty(user_id)
+    flush_user_context(user_id)
+
     return context
 
 def add_user_question(user_id: str, question: str) -> Dict:
     """添加用戶問題到上下文"""
     context = get_user_context(user_id)
     
-    # 添加到問題列表
+    # 添加到問題列表（deque 的 maxlen 自動保留最近 20 個）
     if "questions" not in context:
-        context["questions"] = []
-    
+        context["questions"] = deque(maxlen=MAX_QUESTIONS)
+
     context["questions"].append(question)
-    
-    # 保留最近的20個問題
-    if len(context["questions"]) > 20:
-        context["questions"] = context["questions"][-20:]
-    
-    # 分析問題中的關鍵詞
-    extract_mentions_from_text(user_id, question)
-    
+
+    # 分析問題中的關鍵詞（只改內存，與問題列表合併為一次寫盤）
+    _extract_mentions(context, question)
+
     # 更新時間戳
     context["last_updated"] = int(time.time())
-    
+
     # 保存更新
-    save_user_context(user_id)
-    
+    _mark_dirty(user_id)
+    flush_user_context(user_id)
+
     return context
 
 def add_to_chat_history(user_id: str, user_message: str, bot_response: str) -> Dict:
     """添加对话到聊天历史记录"""
-    context = get_user_context(user_id)
-    
-    # 确保聊天历史记录字段存在
-    if "chat_history" not in context:
-        context["chat_history"] = []
-    
     # 创建新的对话记录
     chat_entry = {
         "timestamp": int(time.time()),
         "user_message": user_message,
         "bot_response": bot_response
     }
-    
+
+    # 優先寫入 Redis（O(1) 追加 + 截斷，跨 worker 共享）
+    if _redis_client is not None:
+        try:
+            key = _chat_history_key(user_id)
+            pipe = _redis_client.pipeline()
+            pipe.rpush(key, json.dumps(chat_entry, ensure_ascii=False))
+            pipe.ltrim(key, -MAX_CHAT_HISTORY, -1)
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            pipe.execute()
+            return get_user_context(user_id)
+        except Exception as e:
+            print(f"寫入 Redis 聊天歷史失敗，回退到本地文件: {e}")
+
+    context = get_user_context(user_id)
+
+    # 确保聊天历史记录字段存在
+    if "chat_history" not in context:
+        context["chat_history"] = []
+
     # 添加到历史记录
     context["chat_history"].append(chat_entry)
-    
+
     # 只保留最近的5条对话
-    if len(context["chat_history"]) > 5:
-        context["chat_history"] = context["chat_history"][-5:]
-    
+    if len(context["chat_history"]) > MAX_CHAT_HISTORY:
+        context["chat_history"] = context["chat_history"][-MAX_CHAT_HISTORY:]
+
     # 保存更新
-    save_user_context(user_id)
-    
+    _mark_dirty(user_id)
+    flush_user_context(user_id)
+
     return context
 
 def get_chat_history(user_id: str, count: int = 5) -> List[Dict]:
     """获取用户最近的聊天历史记录"""
+    # 優先從 Redis 讀取
+    if _redis_client is not None:
+        try:
+            entries = _redis_client.lrange(_chat_history_key(user_id), -count, -1)
+            return [json.loads(entry) for entry in entries]
+        except Exception as e:
+            print(f"讀取 Redis 聊天歷史失敗，回退到本地文件: {e}")
+
     context = get_user_context(user_id)
-    
+
     # 如果没有聊天历史记录，返回空列表
     if "chat_history" not in context:
         return []
-    
+
     # 返回最近的count条记录
     return context["chat_history"][-count:]
 
+def _extract_mentions(context: Dict, text: str) -> List[str]:
+    """從文本中提取關鍵詞並更新 context（只改內存，不寫盤）"""
+    # 初始化提及列表（deque 的 maxlen 自動保留最近 50 個）
+    if "mentions" not in context:
+        context["mentions"] = deque(maxlen=MAX_MENTIONS)
+
+    # 提取關鍵詞：單次正則掃描代替逐關鍵詞的 24 次子串掃描
+    found_mentions = list(dict.fromkeys(_KEYWORD_RE.findall(text)))
+    for keyword in found_mentions:
+        if keyword not in context["mentions"]:
+            context["mentions"].append(keyword)
+
+    return found_mentions
+
 def extract_mentions_from_text(user_id: str, text: str) -> List[str]:
     """從文本中提取提及的關鍵詞"""
     context = get_user_context(user_id)
-    
-    # 佛教相關關鍵詞
-    buddhist_keywords = [
-        "佛陀", "菩薩", "阿羅漢", "四聖諦", "八正道", "中道", "禪修", "冥想",
-        "六妙門", "數息", "隨息", "止", "觀", "還", "淨", "無常", "無我",
-        "空性", "涅槃", "慈悲", "般若", "菩提", "輪迴", "因果", "緣起"
-    ]
-    
-    # 初始化提及列表
-    if "mentions" not in context:
-        context["mentions"] = []
-    
-    # 提取關鍵詞
-    found_mentions = []
-    for keyword in buddhist_keywords:
-        if keyword in text:
-            found_mentions.append(keyword)
-            if keyword not in context["mentions"]:
-                context["mentions"].append(keyword)
-    
-    # 保留最近的50個提及
-    if len(context["mentions"]) > 50:
-        context["mentions"] = context["mentions"][-50:]
-    
+    found_mentions = _extract_mentions(context, text)
+
     # 保存更新
-    save_user_context(user_id)
-    
+    _mark_dirty(user_id)
+    flush_user_context(user_id)
+
     return found_mentions
 
 def analyze_practice_history(user_id: str, text: str) -> str:
@@ -195,23 +327,24 @@ def analyze_practice_history(user_id: str, text: str) -> str:
     
     # 保存原始修行歷史文本
     context["practice_history"] = text
-    
-    # 提取關鍵詞
-    extract_mentions_from_text(user_id, text)
-    
+
+    # 提取關鍵詞（只改內存，與偏好更新合併為一次寫盤）
+    _extract_mentions(context, text)
+
     # 分析偏好的修行方法
     preferred_gates = []
     gates = ["數息", "隨息", "止", "觀", "還", "淨"]
     for gate in gates:
         if gate in text:
             preferred_gates.append(gate)
-    
+
     if preferred_gates:
         context["preferred_gates"] = preferred_gates
-    
+
     # 保存更新
-    save_user_context(user_id)
-    
+    _mark_dirty(user_id)
+    flush_user_context(user_id)
+
     return context["practice_history"]
 
 def get_user_interests(user_id: str) -> List[str]:
@@ -228,10 +361,11 @@ def add_user_interest(user_id: str, interest: str) -> List[str]:
     
     if interest not in context["interests"]:
         context["interests"].append(interest)
-    
+
     # 保存更新
-    save_user_context(user_id)
-    
+    _mark_dirty(user_id)
+    flush_user_context(user_id)
+
     return context["interests"]
 
 def get_user_background(user_id: str) -> str: